@@ -0,0 +1,95 @@
+# Online block averaging (Flyvbjerg and Petersen) of correlated time series
+
+import numpy as np
+import numba as nmb
+
+"""
+    Consecutive MD samples are correlated, so the naive sigma/sqrt(n) underestimates the error
+    of an average. Blocking repeatedly averages neighbouring pairs of samples: at level k the
+    series consists of averages of 2^k samples, which are less and less correlated. The variance
+    estimate of the mean grows with k until the blocks are uncorrelated and then levels off;
+    that plateau is the error estimate.
+
+    Here this is done on the fly: every level only keeps a sample waiting for its partner and
+    the sums needed for the mean and covariance of its block averages, so memory is
+    O(d^2 log n) for n samples of d observables. Keeping the full covariance allows errors of
+    any function of the means (such as a heat capacity) through its gradient.
+"""
+
+# Number of levels, enough for 2^MAX_LEVELS samples
+MAX_LEVELS = 64
+
+# Feeds the rows of samples through the blocking levels
+# Written out elementwise, as temporary arrays per sample and level cost far more than the sums
+@nmb.jit(nopython=True, cache=True)
+def block_accumulate(samples, pending, has_pending, count, sums, sums2):
+  d = samples.shape[1]
+  value = np.empty(d)
+  for s in range(samples.shape[0]):
+    value[:] = samples[s]
+    for k in range(MAX_LEVELS):
+      count[k] += 1
+      for a in range(d):
+        sums[k, a] += value[a]
+        for b in range(d):
+          sums2[k, a, b] += value[a] * value[b]
+      if not has_pending[k]:
+        pending[k] = value
+        has_pending[k] = True
+        break
+      for a in range(d):
+        value[a] = 0.5 * (pending[k, a] + value[a])
+      has_pending[k] = False
+
+class BlockAverager:
+  def __init__(self, d, min_blocks = 16):
+    """
+      d is the number of observables per sample. Levels with fewer than
+      min_blocks blocks are too noisy to be used for the error estimate.
+    """
+
+    self.d = d
+    self.min_blocks = min_blocks
+    self.pending = np.zeros((MAX_LEVELS, d))
+    self.has_pending = np.zeros(MAX_LEVELS, dtype=np.bool_)
+    self.count = np.zeros(MAX_LEVELS, dtype=np.int64)
+    self.sums = np.zeros((MAX_LEVELS, d))
+    self.sums2 = np.zeros((MAX_LEVELS, d, d))
+
+  def add(self, samples):
+    """
+      Adds samples, an array of shape (number of samples, d)
+    """
+
+    block_accumulate(np.ascontiguousarray(samples, dtype=float),
+      self.pending, self.has_pending, self.count, self.sums, self.sums2)
+
+  def n(self):
+    return self.count[0]
+
+  def mean(self):
+    return self.sums[0] / max(self.count[0], 1)
+
+  def covariance_of_mean(self, k):
+    """
+      Covariance matrix of the mean, estimated from the block averages at level k
+    """
+
+    n = self.count[k]
+    m = self.sums[k] / n
+    return (self.sums2[k] / n - np.outer(m, m)) / (n - 1)
+
+  def error(self, gradient):
+    """
+      Standard error of f(mean) for a function f with the given gradient at the mean,
+      taken as the largest estimate over the levels with at least min_blocks blocks
+    """
+
+    gradient = np.asarray(gradient, dtype=float)
+    errors = []
+    for k in range(MAX_LEVELS):
+      if self.count[k] < self.min_blocks:
+        break
+      variance = gradient @ self.covariance_of_mean(k) @ gradient
+      errors.append(np.sqrt(max(variance, 0.0)))
+    return max(errors) if errors else np.nan
@@ -0,0 +1,115 @@
+# Streaming time correlation functions (multiple tau) for MDsimulator
+
+import numpy as np
+import numba as nmb
+
+"""
+    A multiple tau correlator (Ramirez, Sukumaran, Vorselaars and Likhtman, J. Chem. Phys. 133,
+    154103 (2010)) measures a time correlation function on the fly on a logarithmic set of lags.
+    Level 0 keeps the last p samples and correlates every new sample with them (lags 0 .. p-1).
+    Every m samples, level 0 passes a value on to level 1, which works the same way on a time
+    resolution m times coarser, and so on; level l contributes the lags j m^l for j >= p/m.
+    Memory is levels*p samples, so O(log T) for a run of T samples, against the O(T) a full
+    series (or an FFT over it) would need.
+
+    Two kinds of correlation of a per particle vector a(t) are supported:
+      product   <a(t) . a(t + tau)>, e.g. the velocity autocorrelation; the coarser levels see
+                averages of m values, the usual multiple tau smoothing
+      msd       <|a(t + tau) - a(t)|^2>, e.g. the mean squared displacement of unwrapped
+                positions; the coarser levels see every m-th value unchanged, so the lags are exact
+    Both are averaged over time origins and particles.
+"""
+
+# Feeds one sample (flattened per particle vector) through the levels
+@nmb.jit(nopython=True, cache=True)
+def correlator_add(value, product, m, reg, head, filled, corr, count, accum, naccum):
+  levels, p = corr.shape
+  value = value.copy()
+  for l in range(levels):
+    head[l] = (head[l] - 1) % p
+    reg[l, head[l]] = value
+    filled[l] = min(filled[l] + 1, p)
+    jmin = 0 if l == 0 else p // m
+    for j in range(jmin, filled[l]):
+      other = reg[l, (head[l] + j) % p]
+      s = 0.0
+      if product:
+        for k in range(len(value)):
+          s += value[k] * other[k]
+      else:
+        for k in range(len(value)):
+          s += (value[k] - other[k]) ** 2
+      corr[l, j] += s
+      count[l, j] += 1
+
+    # Hand a value to the next level every m samples
+    if product:
+      accum[l] += value
+    else:
+      accum[l] = value
+    naccum[l] += 1
+    if naccum[l] < m:
+      return
+    if product:
+      value = accum[l] / m
+    else:
+      value = accum[l].copy()
+    accum[l] = 0.0
+    naccum[l] = 0
+
+class MultipleTauCorrelator:
+  def __init__(self, n, d, product = True, p = 16, m = 2, levels = 20):
+    """
+      Correlator of a quantity with d components for each of n particles (see the module notes
+      for product). With p points per level and m samples per coarser point, levels levels
+      cover lags up to p m^(levels - 1) samples.
+    """
+
+    if p % m != 0:
+      raise ValueError('p must be a multiple of m')
+    self.n = n
+    self.d = d
+    self.product = product
+    self.p = p
+    self.m = m
+    self.reg = np.zeros((levels, p, n * d))
+    self.head = np.zeros(levels, dtype=np.int64)
+    self.filled = np.zeros(levels, dtype=np.int64)
+    self.corr = np.zeros((levels, p))
+    self.count = np.zeros((levels, p), dtype=np.int64)
+    self.accum = np.zeros((levels, n * d))
+    self.naccum = np.zeros(levels, dtype=np.int64)
+
+  def add(self, value):
+    """
+      Adds the sample value, an (n, d) array
+    """
+
+    correlator_add(np.ascontiguousarray(value, dtype=float).reshape(-1), self.product, self.m,
+      self.reg, self.head, self.filled, self.corr, self.count, self.accum, self.naccum)
+
+  def result(self):
+    """
+      Returns the lags (in samples) that have been measured and the correlation per particle at each
+    """
+
+    levels, p = self.corr.shape
+    lags = []
+    values = []
+    for l in range(levels):
+      for j in range(0 if l == 0 else p // self.m, p):
+        if self.count[l, j] > 0:
+          lags.append(j * self.m ** l)
+          values.append(self.corr[l, j] / (self.count[l, j] * self.n))
+    return np.array(lags), np.array(values)
+
+  def state(self, prefix):
+    """
+      The arrays of the correlator, named with prefix (for checkpoints)
+    """
+
+    return {prefix + name: getattr(self, name) for name in ['reg', 'head', 'filled', 'corr', 'count', 'accum', 'naccum']}
+
+  def set_state(self, prefix, state):
+    for name in ['reg', 'head', 'filled', 'corr', 'count', 'accum', 'naccum']:
+      getattr(self, name)[:] = state[prefix + name]
@@ -0,0 +1,44 @@
+# Runs independent MDsimulator replicas over a grid of parameters on a process pool
+
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from md_template_numba import MDsimulator
+
+"""
+    Every combination of (T, numPerRow, dt, seed) is one replica. Replicas are independent,
+    so they are spread over a pool of worker processes, one replica per task.
+    The result is a table with one row (a dict) per replica, in grid order.
+"""
+
+def run_replica(T, numPerRow, dt, seed, kwargs):
+  """
+    Runs one replica to completion and returns its row of the result table
+  """
+
+  t_start = time.perf_counter()
+  molecules = MDsimulator(T = T, numPerRow = numPerRow, dt = dt, seed = seed, verbose = False, **kwargs)
+  molecules.simulate()
+  row = {'T': T, 'numPerRow': numPerRow, 'dt': dt, 'seed': seed, 'n': molecules.n, 'area': molecules.area}
+  row.update(molecules.averages())
+  row['time'] = time.perf_counter() - t_start
+  return row
+
+def run_ensemble(Ts, numPerRows = [8], dts = [0.01], seeds = [0], processes = None, **kwargs):
+  """
+    Runs one replica for every combination of the given temperatures, box sizes, timesteps and seeds.
+    Other keyword arguments (nsteps, thermalize, ...) are passed on to every MDsimulator.
+    processes defaults to the number of cores.
+  """
+
+  grid = list(itertools.product(Ts, numPerRows, dts, seeds))
+  with ProcessPoolExecutor(max_workers = processes or os.cpu_count()) as pool:
+    futures = [pool.submit(run_replica, T, numPerRow, dt, seed, kwargs) for T, numPerRow, dt, seed in grid]
+    return [future.result() for future in futures]
+
+def print_table(rows, columns = ['T', 'numPerRow', 'dt', 'seed', 'EtotAv', 'Cv', 'P', 'time']):
+  print('\t'.join(columns))
+  for row in rows:
+    print('\t'.join(f'{row[c]:.4g}' if isinstance(row[c], float) else str(row[c]) for c in columns))
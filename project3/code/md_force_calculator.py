@@ -4,11 +4,14 @@
 import numpy as np
 import random as rnd
 import math
+from collections import namedtuple
 
 # Using numba to speed up force calculation
 # More info: https://numba.pydata.org/numba-doc/latest/user/5minguide.html
 import numba as nmb
 
+import md_thermostat as mt
+
 """
     Implement potential and force calculation
 """
@@ -25,6 +28,7 @@ def gaussianRandomNumbers(sigma):
 
 # Assigns random velocity components to all particles taken from a Gaussian
 # distribution with sigma = sqrtKineticEnergyPerParticle, mu = 0
+# (MDsimulator uses the batched and seedable md_thermostat.draw_velocities instead)
 @nmb.jit(nopython=True)
 def thermalize(vx, vy, sqrtKineticEnergyPerParticle):
     for i in range(0, len(vx)):
@@ -49,11 +53,80 @@ def pairForce(r):
     pow6 = r ** 6
     return 4 * (12 / (pow6 ** 2 * r) - 6  / (pow6 * r))
 
-# Calculate the shortest periodic distance, unit cell [0,Lx],[0,Ly]
+"""
+    Pair potentials
+
+    A pair potential is a compiled function pair(r2, params) of the squared distance, so no
+    square root is needed in the pair loop. It returns the pair energy and f/r, where f is the
+    pair force (f > 0 is repulsive), so the force on particle i is (f/r)*(dx, dy). params is a
+    float array holding everything the potential needs, including its cutoff.
+    lennard_jones and tabulated build a PairPotential bundling pair, params and the cutoff rc,
+    which is what the force kernels and the neighbor list need.
+"""
+
+PairPotential = namedtuple('PairPotential', ['pair', 'params', 'rc'])
+
+# Lennard-Jones (epsilon = sigma = 1) truncated at r2 >= params[0] = rc^2 and shifted down by params[1]
+@nmb.jit(nopython=True, cache=True)
+def lennard_jones_pair(r2, params):
+    if r2 >= params[0]:
+        return 0.0, 0.0
+    inv2 = 1.0 / r2
+    inv6 = inv2 * inv2 * inv2
+    return 4.0 * (inv6 * inv6 - inv6) - params[1], (48.0 * inv6 * inv6 - 24.0 * inv6) * inv2
+
+# Lennard-Jones cut at rc, with shift the energy is shifted to go to zero at rc
+def lennard_jones(rc=math.inf, shift=False):
+    eshift = pairEnergy(rc) if shift and rc < math.inf else 0.0
+    return PairPotential(lennard_jones_pair, np.array([rc*rc, eshift]), rc)
+
+# Linear interpolation in tables equally spaced in r2
+# params = [rc^2, r2 of the first entry, 1/spacing, energies..., f/r...]
+@nmb.jit(nopython=True, cache=True)
+def tabulated_pair(r2, params):
+    if r2 >= params[0]:
+        return 0.0, 0.0
+    m = (len(params) - 3) // 2
+    t = (r2 - params[1]) * params[2]
+    k = min(max(int(t), 0), m - 2)
+    t -= k
+    e = (1.0 - t) * params[3 + k] + t * params[4 + k]
+    fr = (1.0 - t) * params[3 + m + k] + t * params[4 + m + k]
+    return e, fr
+
+# Tabulates any potential energy function energy(r) on m points equally spaced in r^2 in [rmin, rc]
+# force(r) = -dU/dr is evaluated by central differences when not given
+def tabulated(energy, rc, rmin=0.5, m=4096, force=None, shift=True):
+    r2 = np.linspace(rmin*rmin, rc*rc, m)
+    r = np.sqrt(r2)
+    if force is None:
+        h = 1e-6
+        force = lambda r: (energy(r - h) - energy(r + h)) / (2*h)
+    eshift = energy(rc) if shift else 0.0
+    e = np.array([energy(ri) for ri in r]) - eshift
+    fr = np.array([force(ri) for ri in r]) / r
+    params = np.concatenate(([rc*rc, r2[0], (m - 1) / (r2[-1] - r2[0])], e, fr))
+    return PairPotential(tabulated_pair, params, rc)
+
+# Shortest periodic image of a separation d in a box of length L, invL = 1/L
+# Rounding instead of looping keeps this branch free, and it works elementwise on arrays
+@nmb.jit(nopython=True, cache=True)
+def minimum_image(d, L, invL):
+    return d - L * np.rint(d * invL)
+
+# Calculate the shortest periodic distance in 2D, unit cell [0,Lx],[0,Ly]
 # Returns the difference along x, along y and the distance
+# The coordinates can be scalars or arrays (e.g. particle i against a block of neighbors)
+@nmb.jit(nopython=True)
+def pbc_dist(x1, y1, x2, y2, Lx, Ly, invLx, invLy):
+    dx = minimum_image(x1 - x2, Lx, invLx)
+    dy = minimum_image(y1 - y2, Ly, invLy)
+    return dx, dy, np.sqrt(dx*dx + dy*dy)
+
+# The previous loop based pbc_dist, kept as reference for benchmark_pbc_dist
 # This code assumes all particles are within [0,Lx],[0,Ly]
 @nmb.jit(nopython=True)
-def pbc_dist(x1, y1, x2, y2, Lx, Ly):
+def pbc_dist_loop(x1, y1, x2, y2, Lx, Ly):
     dx = x1 - x2
     dy = y1 - y2
     while dx < -0.5*Lx:
@@ -66,18 +139,454 @@ def pbc_dist(x1, y1, x2, y2, Lx, Ly):
         dy -= Ly
     return dx, dy, math.sqrt(dx*dx + dy*dy)
 
+"""
+    Particle arrays
+
+    Positions, velocities and forces are contiguous (n, d) arrays, d = 2 or 3, and the box is
+    an array L of d side lengths. The pair loops are written once and take the separation
+    function of the dimension, pair_separation_2d or pair_separation_3d, as an argument. numba
+    compiles them separately for each, and as the separation is a tuple of known length
+    the components stay in registers: a scratch array indexed over len(L), which is only known
+    at run time, made the pair loops several times slower than the original x, y arrays.
+"""
+
+# Minimum image separation (dx, dy) of particles i and j and its squared length
+@nmb.jit(nopython=True, cache=True)
+def pair_separation_2d(pos, i, j, L, invL):
+    dx = minimum_image(pos[i, 0] - pos[j, 0], L[0], invL[0])
+    dy = minimum_image(pos[i, 1] - pos[j, 1], L[1], invL[1])
+    return (dx, dy), dx*dx + dy*dy
+
+# Minimum image separation (dx, dy, dz) of particles i and j and its squared length
+@nmb.jit(nopython=True, cache=True)
+def pair_separation_3d(pos, i, j, L, invL):
+    dx = minimum_image(pos[i, 0] - pos[j, 0], L[0], invL[0])
+    dy = minimum_image(pos[i, 1] - pos[j, 1], L[1], invL[1])
+    dz = minimum_image(pos[i, 2] - pos[j, 2], L[2], invL[2])
+    return (dx, dy, dz), dx*dx + dy*dy + dz*dz
+
+# Adds the pair force (f/r)*dr to particle i and its opposite to particle j
+@nmb.jit(nopython=True, cache=True)
+def add_pair_force(force, i, j, fr, dr):
+    for k in range(len(dr)):
+        force[i, k] += fr * dr[k]
+        force[j, k] -= fr * dr[k]
+
+"""
+    Pair distance histogram
+
+    Every force kernel takes a histogram hist and the inverse bin width scale, and counts each pair
+    it visits into bin int(r*scale), so g(r) comes for free from the distances the forces need
+    anyway (see md_structure.PairCorrelation). Pairs beyond the last bin are ignored, and
+    an empty hist (NO_HISTOGRAM) switches the counting off.
+"""
+
+NO_HISTOGRAM = np.zeros(0, dtype=np.int64)
+
+# Counts a pair at squared distance r2 into hist
+@nmb.jit(nopython=True, cache=True)
+def histogram_pair(hist, scale, r2):
+    if len(hist) > 0:
+        b = int(math.sqrt(r2) * scale)
+        if b < len(hist):
+            hist[b] += 1
+
+# All-pairs force calculation, O(n^2)
+# pair(r2, params) is one of the pair potentials above, e.g. lennard_jones(rc).pair
 @nmb.jit(nopython=True)
-def quick_force_calculation(x, y, fx, fy, Lx, Ly, n) :
+def quick_force_calculation(pos, force, L, n, pair, params, hist, scale) :
+    if pos.shape[1] == 2:
+        return _all_pairs(pos, force, L, n, pair_separation_2d, pair, params, hist, scale)
+    return _all_pairs(pos, force, L, n, pair_separation_3d, pair, params, hist, scale)
+
+@nmb.jit(nopython=True)
+def _all_pairs(pos, force, L, n, separation, pair, params, hist, scale) :
+    invL = 1.0 / L
     Epot = 0.0
     Virial = 0.0
     for i in range(n):
             for j in range(i+1,n):
-                dx, dy, r = pbc_dist(x[i], y[i], x[j], y[j], Lx, Ly)
-                Epot += pairEnergy(r)
-                fij = pairForce(r)
-                Virial -= 0.5*fij*r
-                fx[i] += fij * dx / r
-                fy[i] += fij * dy / r
-                fx[j] -= fij * dx / r
-                fy[j] -= fij * dy / r
-    return Epot, Virial
\ No newline at end of file
+                dr, r2 = separation(pos, i, j, L, invL)
+                e, fr = pair(r2, params)
+                Epot += e
+                Virial -= 0.5*fr*r2
+                add_pair_force(force, i, j, fr, dr)
+                histogram_pair(hist, scale, r2)
+    return Epot, Virial
+
+"""
+    Verlet neighbor list built from a cell list
+
+    Particles are binned into cells of side >= rlist = rc + skin, so all partners of a particle
+    within rlist are found in its own and the 3^d - 1 surrounding cells. The list is stored as a
+    half list in CSR form: the partners j > i of particle i are nbrs[start[i]:start[i+1]].
+    The list stays valid until some particle has moved more than skin/2 since the build.
+"""
+
+# Cell coordinates of position p in a grid of nc cells per dimension, written to cell
+@nmb.jit(nopython=True, cache=True)
+def cell_coords(p, L, nc, cell):
+    for k in range(len(L)):
+        cell[k] = int(math.floor(p[k] / L[k] * nc[k])) % nc[k]
+
+# Flat index of the cell at cell + offset (offset in -1, 0, 1 per dimension), with periodic wrap
+@nmb.jit(nopython=True, cache=True)
+def cell_index(cell, offset, nc):
+    c = 0
+    for k in range(len(nc)):
+        c = c*nc[k] + (cell[k] + offset[k]) % nc[k]
+    return c
+
+# Bins particles into cells as linked lists: head[c] is the first particle
+# in cell c and nxt[i] the particle following i (-1 terminates)
+@nmb.jit(nopython=True, cache=True)
+def build_cell_list(pos, L, nc):
+    n, d = pos.shape
+    head = -np.ones(np.prod(nc), dtype=np.int64)
+    nxt = -np.ones(n, dtype=np.int64)
+    cell = np.empty(d, dtype=np.int64)
+    zero = np.zeros(d, dtype=np.int64)
+    for i in range(n):
+        cell_coords(pos[i], L, nc, cell)
+        c = cell_index(cell, zero, nc)
+        nxt[i] = head[c]
+        head[c] = i
+    return head, nxt
+
+# The flat indices of the 3^d cells around (and including) every cell, row c for cell c
+@nmb.jit(nopython=True, cache=True)
+def cell_stencils(nc):
+    d = len(nc)
+    ncells = np.prod(nc)
+    stencils = np.empty((ncells, 3**d), dtype=np.int64)
+    cell = np.empty(d, dtype=np.int64)
+    offset = np.empty(d, dtype=np.int64)
+    for c in range(ncells):
+        rest = c
+        for k in range(d - 1, -1, -1):
+            cell[k] = rest % nc[k]
+            rest //= nc[k]
+        for o in range(3**d):
+            for m in range(d):
+                offset[m] = (o // 3**m) % 3 - 1
+            stencils[c, o] = cell_index(cell, offset, nc)
+    return stencils
+
+# Visits every pair closer than rlist; with fill=False only counts the partners of each
+# particle into start[i+1], with fill=True writes them to nbrs at start[i]
+# separation is pair_separation_2d or pair_separation_3d
+@nmb.jit(nopython=True)
+def _scan_neighbors(pos, L, rlist, head, nxt, nc, stencils, start, nbrs, fill, separation):
+    n, d = pos.shape
+    invL = 1.0 / L
+    cell = np.empty(d, dtype=np.int64)
+    zero = np.zeros(d, dtype=np.int64)
+    rlist2 = rlist*rlist
+    for i in range(n):
+        k = start[i] if fill else 0
+        if nc.min() < 3:
+            # Too few cells for the 3^d stencil to be unique, fall back to all pairs
+            for j in range(i+1, n):
+                if separation(pos, i, j, L, invL)[1] < rlist2:
+                    if fill:
+                        nbrs[k] = j
+                    k += 1
+        else:
+            cell_coords(pos[i], L, nc, cell)
+            c = cell_index(cell, zero, nc)
+            for o in range(stencils.shape[1]):
+                j = head[stencils[c, o]]
+                while j >= 0:
+                    if j > i and separation(pos, i, j, L, invL)[1] < rlist2:
+                        if fill:
+                            nbrs[k] = j
+                        k += 1
+                    j = nxt[j]
+        if not fill:
+            start[i+1] = k
+
+# Returns (start, nbrs), the half neighbor list of all pairs closer than rlist
+@nmb.jit(nopython=True)
+def build_neighbor_list(pos, L, rlist):
+    if len(L) == 2:
+        return neighbor_list(pos, L, rlist, pair_separation_2d)
+    return neighbor_list(pos, L, rlist, pair_separation_3d)
+
+# build_neighbor_list for the separation function of the dimension
+@nmb.jit(nopython=True)
+def neighbor_list(pos, L, rlist, separation):
+    n = pos.shape[0]
+    nc = np.empty(len(L), dtype=np.int64)
+    for k in range(len(L)):
+        nc[k] = max(int(L[k] / rlist), 1)
+    head, nxt = build_cell_list(pos, L, nc)
+    start = np.zeros(n + 1, dtype=np.int64)
+    nbrs = np.zeros(0, dtype=np.int64)
+    stencils = cell_stencils(nc)
+    # First pass counts, second pass fills the list
+    _scan_neighbors(pos, L, rlist, head, nxt, nc, stencils, start, nbrs, False, separation)
+    start = np.cumsum(start)
+    nbrs = np.empty(start[n], dtype=np.int64)
+    _scan_neighbors(pos, L, rlist, head, nxt, nc, stencils, start, nbrs, True, separation)
+    return start, nbrs
+
+# Largest squared periodic displacement of any particle since the reference positions
+@nmb.jit(nopython=True, cache=True)
+def max_displacement2(pos, ref, L):
+    invL = 1.0 / L
+    dmax2 = 0.0
+    for i in range(pos.shape[0]):
+        r2 = 0.0
+        for k in range(len(L)):
+            d = minimum_image(pos[i, k] - ref[i, k], L[k], invL[k])
+            r2 += d*d
+        dmax2 = max(dmax2, r2)
+    return dmax2
+
+# Same as quick_force_calculation, but only visits the pairs in the neighbor list
+@nmb.jit(nopython=True)
+def neighbor_force_calculation(pos, force, L, n, start, nbrs, pair, params, hist, scale):
+    if pos.shape[1] == 2:
+        return _neighbor_pairs(pos, force, L, n, start, nbrs, pair_separation_2d, pair, params, hist, scale)
+    return _neighbor_pairs(pos, force, L, n, start, nbrs, pair_separation_3d, pair, params, hist, scale)
+
+@nmb.jit(nopython=True)
+def _neighbor_pairs(pos, force, L, n, start, nbrs, separation, pair, params, hist, scale):
+    invL = 1.0 / L
+    Epot = 0.0
+    Virial = 0.0
+    for i in range(n):
+        for k in range(start[i], start[i+1]):
+            j = nbrs[k]
+            dr, r2 = separation(pos, i, j, L, invL)
+            e, fr = pair(r2, params)
+            Epot += e
+            Virial -= 0.5*fr*r2
+            add_pair_force(force, i, j, fr, dr)
+            histogram_pair(hist, scale, r2)
+    return Epot, Virial
+
+"""
+    Thread parallel force calculation
+
+    The rows i of the pair loop are dealt out cyclically to nblocks blocks, which keeps the
+    triangular i<j loop balanced. Each block accumulates into its own force buffer, and the
+    buffers are summed per particle in block order afterwards. Since the work of a block does
+    not depend on which thread runs it, the result is bitwise reproducible for a fixed nblocks
+    (by default the number of numba threads). Pair histograms are kept per block as well.
+"""
+
+# Sums the per block force buffers, histograms and partial energies in a fixed order
+@nmb.jit(nopython=True, parallel=True, cache=True)
+def _reduce_blocks(force, forceb, hist, histb, Eb, Vb):
+    nblocks, n, d = forceb.shape
+    for i in nmb.prange(n):
+        for b in range(nblocks):
+            for k in range(d):
+                force[i, k] += forceb[b, i, k]
+    for b in range(nblocks):
+        hist += histb[b]
+    Epot = 0.0
+    Virial = 0.0
+    for b in range(nblocks):
+        Epot += Eb[b]
+        Virial += Vb[b]
+    return Epot, Virial
+
+# Parallel version of quick_force_calculation
+@nmb.jit(nopython=True)
+def parallel_force_calculation(pos, force, L, n, pair, params, hist, scale, nblocks):
+    if pos.shape[1] == 2:
+        return _parallel_all_pairs(pos, force, L, n, pair_separation_2d, pair, params, hist, scale, nblocks)
+    return _parallel_all_pairs(pos, force, L, n, pair_separation_3d, pair, params, hist, scale, nblocks)
+
+@nmb.jit(nopython=True, parallel=True)
+def _parallel_all_pairs(pos, force, L, n, separation, pair, params, hist, scale, nblocks):
+    invL = 1.0 / L
+    forceb = np.zeros((nblocks, n, len(L)), dtype=force.dtype)
+    histb = np.zeros((nblocks, len(hist)), dtype=np.int64)
+    Eb = np.zeros(nblocks)
+    Vb = np.zeros(nblocks)
+    for b in nmb.prange(nblocks):
+        Epot = 0.0
+        Virial = 0.0
+        for i in range(b, n, nblocks):
+            for j in range(i+1, n):
+                dr, r2 = separation(pos, i, j, L, invL)
+                e, fr = pair(r2, params)
+                Epot += e
+                Virial -= 0.5*fr*r2
+                add_pair_force(forceb[b], i, j, fr, dr)
+                histogram_pair(histb[b], scale, r2)
+        Eb[b] = Epot
+        Vb[b] = Virial
+    return _reduce_blocks(force, forceb, hist, histb, Eb, Vb)
+
+# Parallel version of neighbor_force_calculation
+@nmb.jit(nopython=True)
+def parallel_neighbor_force_calculation(pos, force, L, n, start, nbrs, pair, params, hist, scale, nblocks):
+    if pos.shape[1] == 2:
+        return _parallel_neighbor_pairs(pos, force, L, n, start, nbrs, pair_separation_2d, pair, params, hist, scale, nblocks)
+    return _parallel_neighbor_pairs(pos, force, L, n, start, nbrs, pair_separation_3d, pair, params, hist, scale, nblocks)
+
+@nmb.jit(nopython=True, parallel=True)
+def _parallel_neighbor_pairs(pos, force, L, n, start, nbrs, separation, pair, params, hist, scale, nblocks):
+    invL = 1.0 / L
+    forceb = np.zeros((nblocks, n, len(L)), dtype=force.dtype)
+    histb = np.zeros((nblocks, len(hist)), dtype=np.int64)
+    Eb = np.zeros(nblocks)
+    Vb = np.zeros(nblocks)
+    for b in nmb.prange(nblocks):
+        Epot = 0.0
+        Virial = 0.0
+        for i in range(b, n, nblocks):
+            for k in range(start[i], start[i+1]):
+                j = nbrs[k]
+                dr, r2 = separation(pos, i, j, L, invL)
+                e, fr = pair(r2, params)
+                Epot += e
+                Virial -= 0.5*fr*r2
+                add_pair_force(forceb[b], i, j, fr, dr)
+                histogram_pair(histb[b], scale, r2)
+        Eb[b] = Epot
+        Vb[b] = Virial
+    return _reduce_blocks(force, forceb, hist, histb, Eb, Vb)
+
+# One velocity Verlet step for all particles in a single pass:
+# closing half kick (skipped at the first step, where v is already the full step velocity),
+# kinetic energy, opening half kick, drift and periodic wrap. Returns the kinetic energy.
+@nmb.jit(nopython=True, cache=True)
+def propagate_velocity_verlet(pos, vel, force, mass, invmass, dt, L, first_step):
+    n, d = pos.shape
+    Ekin = 0.0
+    for i in range(n):
+        for k in range(d):
+            if not first_step:
+                vel[i, k] += force[i, k]*invmass*0.5*dt
+            Ekin += 0.5*mass*vel[i, k]*vel[i, k]
+            vel[i, k] += force[i, k]*invmass*0.5*dt
+            pos[i, k] = (pos[i, k] + vel[i, k] * dt) % L[k]
+    return Ekin
+
+"""
+    Step kernels
+
+    run_md_steps takes its force kernel, neighbor list update and propagator as arguments, like
+    the pair potential, and select_step_kernels picks them in Python from the simulator's
+    settings. numba then compiles only the variant that is run, instead of every combination
+    of force method, dimension and integrator at the first call. The functions of each kind
+    share one signature, so they can stand in for each other.
+    numba does not cache functions that take other compiled functions as arguments, so those are
+    compiled again in every process; the others are cached on disk.
+"""
+
+StepKernels = namedtuple('StepKernels', ['forces', 'update_list', 'propagate', 'separation'])
+
+# Force kernels: add the forces of all pairs (or those in the neighbor list start, nbrs) and
+# return the potential energy, the virial and the number of pairs visited
+@nmb.jit(nopython=True)
+def all_pairs_forces(pos, force, L, n, start, nbrs, separation, pair, params, hist, scale, nblocks):
+    Epot, Virial = _all_pairs(pos, force, L, n, separation, pair, params, hist, scale)
+    return Epot, Virial, n*(n - 1)//2
+
+@nmb.jit(nopython=True)
+def neighbor_forces(pos, force, L, n, start, nbrs, separation, pair, params, hist, scale, nblocks):
+    Epot, Virial = _neighbor_pairs(pos, force, L, n, start, nbrs, separation, pair, params, hist, scale)
+    return Epot, Virial, start[n]
+
+# The parallel force kernels, splitting the particles into nblocks blocks
+@nmb.jit(nopython=True)
+def parallel_all_pairs_forces(pos, force, L, n, start, nbrs, separation, pair, params, hist, scale, nblocks):
+    Epot, Virial = _parallel_all_pairs(pos, force, L, n, separation, pair, params, hist, scale, nblocks)
+    return Epot, Virial, n*(n - 1)//2
+
+@nmb.jit(nopython=True)
+def parallel_neighbor_forces(pos, force, L, n, start, nbrs, separation, pair, params, hist, scale, nblocks):
+    Epot, Virial = _parallel_neighbor_pairs(pos, force, L, n, start, nbrs, separation, pair, params, hist, scale, nblocks)
+    return Epot, Virial, start[n]
+
+# Neighbor list updates: rebuild the list (start, nbrs) of radius rc + skin, and store the
+# reference positions ref, once some particle has moved more than skin/2 since the last build;
+# return the list and whether it was rebuilt
+@nmb.jit(nopython=True)
+def update_neighbor_list(pos, L, rc, skin, start, nbrs, ref, separation):
+    if max_displacement2(pos, ref, L) > 0.25*skin*skin:
+        start, nbrs = neighbor_list(pos, L, rc + skin, separation)
+        ref[:] = pos
+        return start, nbrs, True
+    return start, nbrs, False
+
+@nmb.jit(nopython=True)
+def no_neighbor_list(pos, L, rc, skin, start, nbrs, ref, separation):
+    return start, nbrs, False
+
+# Propagators, with the signature of md_thermostat.propagate_baoab
+@nmb.jit(nopython=True)
+def velocity_verlet(pos, vel, force, mass, invmass, dt, L, first_step, gamma, kBT, rng):
+    return propagate_velocity_verlet(pos, vel, force, mass, invmass, dt, L, first_step)
+
+# The step kernels for a simulator in dim dimensions with the given force_method
+# ('all_pairs' or 'neighbor_list'), using the parallel force kernels if parallel and
+# integrating with BAOAB if langevin
+def select_step_kernels(dim, force_method, parallel, langevin):
+    use_nlist = force_method == 'neighbor_list'
+    if parallel:
+        forces = parallel_neighbor_forces if use_nlist else parallel_all_pairs_forces
+    else:
+        forces = neighbor_forces if use_nlist else all_pairs_forces
+    return StepKernels(
+        forces = forces,
+        update_list = update_neighbor_list if use_nlist else no_neighbor_list,
+        propagate = mt.propagate_baoab if langevin else velocity_verlet,
+        separation = pair_separation_2d if dim == 2 else pair_separation_3d)
+
+# Advances nsteps MD steps without leaving compiled code, mirroring MDsimulator.md_step:
+# clear, forces, thermostat, propagate, accumulate averages. thermostat, thermo_interval and
+# thermo_param select the thermostat as in md_thermostat, drawing from the Generator rng.
+# sums = [Virial, Ekin, Epot, Etot, Etot^2] is updated in place.
+# The pair potential is given by pair and params, its cutoff rc sets the neighbor list radius.
+# forces, update_list, propagate and separation are the StepKernels of select_step_kernels;
+# update_list keeps the neighbor list (start, nbrs, ref) up to date.
+# Pair distances are counted into hist (bin width 1/scale) at the steps that are averaged.
+# nblocks is the number of blocks of the parallel force kernels.
+# Row s - step of samples receives [Ekin, Epot, Virial, Etot^2] of step s, after propagation.
+# Returns Epot, Ekin and Virial of the last step, the neighbor list, the number of rebuilds
+# and the number of pairs the force kernels visited.
+@nmb.jit(nopython=True)
+def run_md_steps(pos, vel, force, mass, invmass, dt, L, pair, params, rc,
+                 kBT, thermostat, thermo_interval, thermo_param, rng,
+                 step, nsteps, startStepForAveraging, sums, forces, update_list, propagate, separation,
+                 skin, start, nbrs, ref, nblocks, samples, hist, scale):
+    n = pos.shape[0]
+    no_hist = np.zeros(0, dtype=np.int64)
+    rebuilds = 0
+    pairs = 0
+    Epot = 0.0
+    Ekin = 0.0
+    Virial = 0.0
+    for s in range(step, step + nsteps):
+        Epot = 0.0
+        Ekin = 0.0
+        Virial = 0.0
+        force[:] = 0.0
+        h = hist if s > startStepForAveraging else no_hist
+        start, nbrs, rebuilt = update_list(pos, L, rc, skin, start, nbrs, ref, separation)
+        if rebuilt:
+            rebuilds += 1
+        tEpot, tVirial, tpairs = forces(pos, force, L, n, start, nbrs, separation, pair, params, h, scale, nblocks)
+        pairs += tpairs
+        Epot += tEpot
+        Virial += tVirial
+        mt.apply_thermostat(thermostat, thermo_interval, thermo_param, s, vel, mass, kBT, dt, rng)
+        Ekin += propagate(pos, vel, force, mass, invmass, dt, L, s == 0, thermo_param, kBT, rng)
+        if s > startStepForAveraging:
+            sums[0] += Virial
+            sums[1] += Ekin
+            sums[2] += Epot
+            sums[3] += Epot + Ekin
+            sums[4] += (Epot + Ekin)*(Epot + Ekin)
+        samples[s - step, 0] = Ekin
+        samples[s - step, 1] = Epot
+        samples[s - step, 2] = Virial
+        samples[s - step, 3] = (Ekin + Epot)*(Ekin + Epot)
+    return Epot, Ekin, Virial, start, nbrs, rebuilds, pairs
@@ -0,0 +1,158 @@
+# Initial configurations for MDsimulator
+
+import math
+import numpy as np
+import numba as nmb
+
+"""
+    All generators take the number of particles n and the box L (an array of d side lengths,
+    see box_for_density) and return an (n, d) array of positions inside the box.
+
+    The lattices fill the box with a whole number of rows in every direction, so they are
+    periodic with the box; if n is not a product of the row counts the last sites stay empty.
+
+    Random sequential insertion places particles one by one at uniformly random positions and
+    rejects those closer than rmin to a particle already placed. The placed particles are hashed
+    into a grid of cells with a diagonal of at most rmin, which holds at most one particle per
+    cell, so every trial only looks at the few cells around it and the fill is O(n).
+    Insertion stalls towards the jamming coverage (area fraction 0.547 in 2D, volume fraction
+    0.38 in 3D, for spheres of diameter rmin).
+"""
+
+def box_for_density(n, density, d = 2):
+  """
+    Side lengths of the square (cubic) box holding n particles at the given number density
+  """
+
+  return np.full(d, (n / density) ** (1.0 / d))
+
+def rows_for_box(n, L, aspect):
+  """
+    Number of rows per direction for at least n sites, as equal a spacing as possible in a
+    box L, where aspect[k] is the row spacing of direction k relative to the lattice constant
+  """
+
+  L = np.asarray(L, dtype=float)
+  a = (np.prod(L / aspect) / n) ** (1.0 / len(L))
+  rows = np.maximum(np.rint(L / (a * aspect)).astype(np.int64), 1)
+  # Round up the direction that needs the fewest extra sites until n fit
+  while np.prod(rows) < n:
+    k = np.argmin(rows / (L / aspect))
+    rows[k] += 1
+  return rows
+
+def square_lattice(n, L):
+  """
+    Square (simple cubic) lattice
+  """
+
+  L = np.asarray(L, dtype=float)
+  rows = rows_for_box(n, L, np.ones(len(L)))
+  index = np.indices(rows).reshape(len(L), -1).T[:n]
+  return (index + 0.5) * (L / rows)
+
+def triangular_lattice(n, L):
+  """
+    Triangular lattice in 2D (with an even number of rows, so it is periodic),
+    face centered cubic in 3D
+  """
+
+  L = np.asarray(L, dtype=float)
+  if len(L) == 2:
+    basis = np.array([[0.0, 0.0], [0.5, 0.5]])
+    aspect = np.array([1.0, math.sqrt(3.0)])
+  else:
+    basis = np.array([[0.0, 0.0, 0.0], [0.5, 0.5, 0.0], [0.5, 0.0, 0.5], [0.0, 0.5, 0.5]])
+    aspect = np.ones(3)
+  # Unit cells of len(basis) sites
+  cells = rows_for_box(math.ceil(n / len(basis)), L, aspect)
+  index = np.indices(cells).reshape(len(L), -1).T
+  sites = (index[:, None, :] + basis[None, :, :] + 0.25).reshape(-1, len(L))
+  return sites[:n] * (L / cells)
+
+@nmb.jit(nopython=True, cache=True)
+def _insert(pos, L, rmin, rng, max_attempts):
+  n, d = pos.shape
+  nc = np.empty(d, dtype=np.int64)
+  for k in range(d):
+    nc[k] = math.ceil(L[k] * math.sqrt(d) / rmin)
+  grid = -np.ones(np.prod(nc), dtype=np.int32)
+  cell = np.empty(d, dtype=np.int64)
+  p = np.empty(d)
+  rmin2 = rmin * rmin
+  # Offsets of the cells that can hold a particle within rmin of the trial cell,
+  # the last dimension running fastest for memory locality
+  reach = 0
+  for k in range(d):
+    reach = max(reach, math.ceil(rmin * nc[k] / L[k]))
+  span = 2 * reach + 1
+  offsets = np.empty((span ** d, d), dtype=np.int64)
+  m = 0
+  for o in range(span ** d):
+    gap2 = 0.0
+    for k in range(d):
+      offsets[m, k] = (o // span ** (d - 1 - k)) % span - reach
+      gap = max(abs(offsets[m, k]) - 1, 0) * L[k] / nc[k]
+      gap2 += gap * gap
+    if gap2 < rmin2:
+      m += 1
+  offsets = offsets[:m]
+
+  placed = 0
+  attempts = 0
+  batch = 4096
+  trial = rng.random((batch, d))
+  t = 0
+  while placed < n:
+    if attempts >= max_attempts:
+      return placed
+    attempts += 1
+    if t == batch:
+      trial = rng.random((batch, d))
+      t = 0
+    for k in range(d):
+      p[k] = trial[t, k] * L[k]
+      cell[k] = min(int(trial[t, k] * nc[k]), nc[k] - 1)
+    t += 1
+    ok = True
+    for o in range(m):
+      c = 0
+      for k in range(d):
+        ck = cell[k] + offsets[o, k]
+        if ck < 0 or ck >= nc[k]:
+          ck %= nc[k]
+        c = c * nc[k] + ck
+      j = grid[c]
+      if j >= 0:
+        r2 = 0.0
+        for k in range(d):
+          dk = p[k] - pos[j, k]
+          dk -= L[k] * np.rint(dk / L[k])
+          r2 += dk * dk
+        if r2 < rmin2:
+          ok = False
+          break
+    if ok:
+      # The cell is empty, any particle in it would be within rmin
+      c = 0
+      for k in range(d):
+        c = c * nc[k] + cell[k]
+      grid[c] = placed
+      pos[placed] = p
+      placed += 1
+  return placed
+
+def random_sequential_insertion(n, L, rmin, rng, max_attempts = None):
+  """
+    n particles at random positions, no two closer than rmin, drawn from the Generator rng.
+    Gives up after max_attempts trials (default 1000 n).
+  """
+
+  L = np.asarray(L, dtype=float)
+  if max_attempts is None:
+    max_attempts = 1000 * n
+  pos = np.zeros((n, len(L)))
+  placed = _insert(pos, L, rmin, rng, max_attempts)
+  if placed < n:
+    raise RuntimeError(f'Random insertion placed only {placed} of {n} particles, the box is too full for rmin = {rmin}')
+  return pos
@@ -0,0 +1,89 @@
+# Per phase timing and counters for MDsimulator
+
+import time
+
+"""
+    The simulator marks the end of every phase of its loop with lap(phase), which charges the
+    wall time since the previous mark to that phase. The phases therefore cover the whole run
+    without gaps or overlaps and add up to the wall time.
+
+    A clock read costs a sizeable fraction of a percent of a Python MD step, so the phases inside
+    a step are only timed at every sample_interval-th step. The other steps run without any
+    clock read; their time ends up in 'steps' and is split over the phases of a step in
+    proportion to the sampled steps when the record is made. Rare events (neighbor list rebuilds,
+    output) are always timed: lap('steps') closes the untimed stretch before them.
+    The compiled kernel is timed as a whole at every call.
+    The counters (steps, pair interactions, neighbor list rebuilds) are exact.
+
+    Phases of MDsimulator:
+      neighbor_list   rebuilding the Verlet list
+      forces          force kernel, including the check whether the list is still valid
+      thermostat      Andersen or Berendsen velocity updates
+      propagate       velocity Verlet or BAOAB integration
+      averaging       running sums and block averages
+      kernel          md.run_md_steps (steps_in_kernel): all of the above per step, compiled
+      output          trajectory, rendering and correlation samples
+      frame           energy lists, heat capacity output and the drift watchdog after every frame
+      checkpoint      writing checkpoints
+"""
+
+# The phases of a step that share the time of the steps that were not timed
+STEP_PHASES = ('forces', 'averaging', 'thermostat', 'propagate')
+
+class Profiler:
+  def __init__(self, sample_interval = 16):
+    self.sample_interval = sample_interval
+    self.start()
+
+  def start(self):
+    """
+      Clears all timings and counters and starts the clock; the time until the next lap
+      is charged to its phase
+    """
+
+    self.phases = {}
+    self.steps = 0
+    self.pair_interactions = 0
+    self.nlist_rebuilds = 0
+    self.last = time.perf_counter()
+
+  def lap(self, phase):
+    now = time.perf_counter()
+    self.phases[phase] = self.phases.get(phase, 0.0) + (now - self.last)
+    self.last = now
+
+  def record(self):
+    """
+      Timings and counters as a plain dictionary: wall time, seconds and fraction per phase,
+      the counters, steps per second and pair interactions per second of force time
+      (the kernel phase counts as force time, as the compiled steps are not split up)
+    """
+
+    phases = dict(self.phases)
+    untimed = phases.pop('steps', 0.0)
+    sampled = sum(phases.get(phase, 0.0) for phase in STEP_PHASES)
+    if sampled > 0:
+      for phase in STEP_PHASES:
+        if phase in phases:
+          phases[phase] += untimed * phases[phase] / sampled
+    elif untimed > 0:
+      phases['steps'] = untimed
+    wall = sum(phases.values())
+    force_time = phases.get('forces', 0.0) + phases.get('kernel', 0.0)
+    return {
+      'wall': wall,
+      'phases': phases,
+      'fractions': {phase: t / wall for phase, t in phases.items()} if wall > 0 else {},
+      'steps': self.steps,
+      'pair_interactions': self.pair_interactions,
+      'nlist_rebuilds': self.nlist_rebuilds,
+      'steps_per_second': self.steps / wall if wall > 0 else 0.0,
+      'pair_interactions_per_second': self.pair_interactions / force_time if force_time > 0 else 0.0,
+    }
+
+  def report(self):
+    record = self.record()
+    print(f"{record['steps']} steps in {record['wall']:.3f} s, {record['steps_per_second']:.0f} steps/s,",
+      f"{record['pair_interactions_per_second']:.3g} pair interactions/s, {record['nlist_rebuilds']} neighbor list rebuilds")
+    for phase, t in sorted(record['phases'].items(), key = lambda item: -item[1]):
+      print(f'  {phase:14s} {t:9.4f} s  {100 * record["fractions"][phase]:5.1f}%')
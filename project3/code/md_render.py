@@ -0,0 +1,128 @@
+# Headless frame rendering for MDsimulator
+
+import math
+import subprocess
+import numpy as np
+import numba as nmb
+import matplotlib.image as mpimg
+
+from md_worker import BackgroundWorker
+
+"""
+    Frames are drawn without matplotlib: rasterize paints the particles as discs (with periodic
+    wrap) straight into an RGB image array, which is reused for every frame. 3D systems are
+    drawn as their projection on the xy plane.
+
+    Like md_trajectory.TrajectoryWriter, FrameRenderer uses a md_worker.BackgroundWorker: the
+    simulation only copies the positions into one of two buffers and goes on integrating, while
+    the worker thread rasterizes them and writes the image. rasterize releases the GIL, so
+    drawing really runs in parallel with the simulation. Frames go to an image sequence if the filename contains a %d style field
+    (e.g. 'frames/md_%05d.png'), otherwise to a video encoded by ffmpeg (which has to be installed,
+    as for matplotlib's animation writers). ffmpeg is only started at the first frame.
+    resume continues an image sequence at a later frame number, for runs restarted from a
+    checkpoint; a video cannot be continued.
+"""
+
+# Draws discs of the given radius (in box units) at the xy positions, with periodic wrap
+@nmb.jit(nopython=True, nogil=True, cache=True)
+def rasterize(pos, L, image, radius, color, background):
+  h, w, _ = image.shape
+  image[:, :] = background
+  sx = w / L[0]
+  sy = h / L[1]
+  rx = radius * sx
+  ry = radius * sy
+  for i in range(pos.shape[0]):
+    # Image rows run downwards
+    cx = pos[i, 0] * sx
+    cy = (L[1] - pos[i, 1]) * sy
+    for py in range(int(math.floor(cy - ry)), int(math.ceil(cy + ry)) + 1):
+      dy = (py + 0.5 - cy) / ry
+      for px in range(int(math.floor(cx - rx)), int(math.ceil(cx + rx)) + 1):
+        dx = (px + 0.5 - cx) / rx
+        if dx * dx + dy * dy <= 1.0:
+          image[py % h, px % w] = color
+
+class FrameRenderer:
+  def __init__(self, filename, L, n, width = 512, radius = 0.5, fps = 25,
+      color = (220, 30, 30), background_color = (255, 255, 255), background = True):
+    """
+      Renders the first two coordinates of n particles in the box L to width pixel wide frames,
+      with discs of the given radius in box units. fps is the frame rate of a video.
+    """
+
+    self.filename = filename
+    self.L = np.asarray(L, dtype=float)
+    self.n = n
+    self.width = width
+    self.height = max(int(round(width * self.L[1] / self.L[0])), 1)
+    self.radius = radius
+    self.color = np.array(color, dtype=np.uint8)
+    self.background_color = np.array(background_color, dtype=np.uint8)
+    self.image = np.empty((self.height, self.width, 3), dtype=np.uint8)
+    self.frames = 0
+
+    self.sequence = '%' in filename
+    self.fps = fps
+    self.video = None
+
+    self.buffer = np.empty((n, len(self.L)))
+    self.worker = None
+    if background:
+      self.worker = BackgroundWorker(self.render, np.empty((n, len(self.L))))
+
+  def append(self, pos):
+    """
+      Copies the positions and hands them over for rendering
+    """
+
+    if self.worker is not None:
+      self.worker.check()
+    self.buffer[:] = pos
+    if self.worker is not None:
+      self.buffer = self.worker.submit(self.buffer)
+    else:
+      self.render(self.buffer)
+
+  def resume(self, frames):
+    """
+      Numbers the next image of the sequence frames, keeping the images before it
+    """
+
+    if frames > 0 and not self.sequence:
+      raise ValueError(f'The video {self.filename} cannot be continued, render to an image sequence instead')
+    self.frames = frames
+
+  def sync(self):
+    """
+      Waits until all frames handed over are drawn and returns their number
+    """
+
+    if self.worker is not None:
+      self.worker.join()
+    return self.frames
+
+  def render(self, pos):
+    rasterize(pos, self.L, self.image, self.radius, self.color, self.background_color)
+    if self.sequence:
+      mpimg.imsave(self.filename % self.frames, self.image)
+    else:
+      if self.video is None:
+        self.video = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+          '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{self.width}x{self.height}', '-r', str(self.fps), '-i', '-',
+          '-pix_fmt', 'yuv420p', self.filename], stdin = subprocess.PIPE)
+      self.video.stdin.write(self.image.tobytes())
+    self.frames += 1
+
+  def close(self):
+    """
+      Renders the remaining frame and waits for the thread and the video encoder to finish
+    """
+
+    try:
+      if self.worker is not None:
+        self.worker.close()
+    finally:
+      if self.video is not None and not self.video.stdin.closed:
+        self.video.stdin.close()
+        self.video.wait()
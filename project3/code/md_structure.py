@@ -0,0 +1,81 @@
+# Radial distribution function and structure factor for MDsimulator
+
+import numpy as np
+
+"""
+    g(r) is accumulated on the fly: the force kernels count every pair they visit into a
+    histogram of pair distances (see md.histogram_pair), so sampling it costs one square root
+    per pair instead of a separate O(n^2) pass over stored positions. The histogram is only
+    normalized when g(r) is asked for.
+
+    The structure factor follows from g(r) by the Fourier transform of h(r) = g(r) - 1,
+      3D: S(k) = 1 + 4 pi rho int r^2 h(r) sin(kr)/(kr) dr
+      2D: S(k) = 1 + 2 pi rho int r h(r) J0(kr) dr
+    taken over the histogram range. Cutting the integral at rmax puts ripples of period
+    2 pi/rmax on S(k), so it is only meaningful for k well above 2 pi/rmax.
+"""
+
+def bessel_j0(x, m = 64):
+  """
+    J0(x) = 1/pi int_0^pi cos(x sin t) dt, by the trapezoidal rule on m points
+    (spectrally accurate, as the integrand is periodic)
+  """
+
+  t = np.pi * (np.arange(m) + 0.5) / m
+  return np.cos(np.multiply.outer(x, np.sin(t))).mean(axis=-1)
+
+class PairCorrelation:
+  def __init__(self, rmax, bins, n, L):
+    """
+      Histogram of bins bins over pair distances [0, rmax) for n particles in the periodic box L.
+      rmax can be at most half the shortest box side, beyond that the minimum image misses pairs.
+    """
+
+    self.L = np.asarray(L, dtype=float)
+    if rmax > 0.5 * self.L.min():
+      raise ValueError(f'rmax = {rmax} is larger than half the box ({0.5 * self.L.min()})')
+    self.rmax = rmax
+    self.bins = bins
+    self.n = n
+    self.d = len(self.L)
+    self.scale = bins / rmax
+    self.hist = np.zeros(bins, dtype=np.int64)
+    self.samples = 0
+
+  def r(self):
+    """
+      Bin centers
+    """
+
+    return (np.arange(self.bins) + 0.5) / self.scale
+
+  def density(self):
+    return self.n / np.prod(self.L)
+
+  def g(self):
+    """
+      Returns r and g(r): the pair counts per sample divided by those of an ideal gas
+      at the same density (each pair is counted once, hence the factor 2)
+    """
+
+    edges = np.arange(self.bins + 1) / self.scale
+    if self.d == 2:
+      shell = np.pi * np.diff(edges**2)
+    else:
+      shell = 4.0 / 3.0 * np.pi * np.diff(edges**3)
+    ideal = 0.5 * self.n * self.density() * shell
+    return self.r(), self.hist / (max(self.samples, 1) * ideal)
+
+  def structure_factor(self, k):
+    """
+      S(k) at the wave numbers k from the Fourier transform of g(r)
+    """
+
+    r, g = self.g()
+    dr = 1.0 / self.scale
+    kr = np.multiply.outer(np.asarray(k, dtype=float), r)
+    if self.d == 2:
+      kernel = 2.0 * np.pi * r * bessel_j0(kr)
+    else:
+      kernel = 4.0 * np.pi * r * r * np.sinc(kr / np.pi)
+    return 1.0 + self.density() * (kernel * (g - 1.0)).sum(axis=-1) * dr
@@ -0,0 +1,177 @@
+# Replica exchange (parallel tempering) over MDsimulator replicas in worker processes
+
+import math
+import multiprocessing
+import numpy as np
+
+import md_thermostat as mt
+from md_template_numba import MDsimulator
+
+"""
+    M replicas run at a ladder of temperatures T[0] < ... < T[M-1], each in its own worker
+    process that keeps its MDsimulator between exchanges. After every exchange_interval steps,
+    neighbouring ladder slots k, k+1 (even pairs and odd pairs in turn) try to swap with the
+    Metropolis probability
+      min(1, exp((1/kB T[k] - 1/kB T[k+1]) (Epot[k] - Epot[k+1])))
+    Instead of the configurations, the two replicas swap temperatures: each one rescales its
+    velocities by sqrt(T_new/T_old) and carries on with the thermostat at its new temperature,
+    so only a few numbers go between the processes. Epot is the potential energy of the last
+    force evaluation, one step behind the positions, as in most MD tempering codes.
+
+    The replicas need a thermostat (Langevin by default) for the canonical ensemble.
+    Averages are collected per temperature from the per step samples of every replica while it
+    was at that temperature. A round trip is a replica going from the lowest temperature
+    to the highest and back, the round trip time is measured in MD steps.
+"""
+
+def replica_worker(conn, T, seed, kwargs):
+  """
+    Worker process loop holding one replica. It first sends n, dim and the volume. Commands are
+    ('run', nsteps, T), which first changes the temperature if T is not None and then returns
+    Epot and the sample count and sums of the steps run, and ('stop',).
+  """
+
+  molecules = MDsimulator(T = T, seed = seed, verbose = False, **kwargs)
+  conn.send((molecules.n, molecules.dim, molecules.volume))
+  while True:
+    command = conn.recv()
+    if command[0] == 'stop':
+      conn.close()
+      return
+    _, nsteps, T = command
+    if T is not None:
+      molecules.vel *= math.sqrt(T / molecules.T)
+      molecules.T = T
+      molecules.kBT = T
+    count = molecules.blocks.count[0]
+    sums = molecules.blocks.sums[0].copy()
+    molecules.md_steps_in_kernel(nsteps)
+    conn.send((molecules.Epot, molecules.blocks.count[0] - count, molecules.blocks.sums[0] - sums))
+
+class ParallelTempering:
+  def __init__(self, Ts, exchange_interval = 1000, seed = 0, thermostat = 'langevin', **kwargs):
+    """
+      Starts one worker per temperature in Ts (sorted ascending). Other keyword arguments
+      are passed on to every MDsimulator. seed seeds the replicas and the exchanges.
+    """
+
+    self.Ts = sorted(Ts)
+    self.m = len(self.Ts)
+    self.exchange_interval = exchange_interval
+    seeds = np.random.SeedSequence(seed).spawn(self.m + 1)
+    self.rng = mt.make_rng(seeds[-1])
+    kwargs = dict(kwargs, thermostat = thermostat)
+    # Replica r sits at ladder slot slot_of[r], replica_at[k] is the replica at slot k
+    self.slot_of = np.arange(self.m)
+    self.replica_at = np.arange(self.m)
+    self.epot = np.zeros(self.m)
+    self.pending_T = [None] * self.m
+
+    self.attempts = np.zeros(self.m - 1, dtype=np.int64)
+    self.accepted = np.zeros(self.m - 1, dtype=np.int64)
+    self.count = np.zeros(self.m, dtype=np.int64)
+    self.sums = np.zeros((self.m, 4))
+    self.step = 0
+    self.exchanges = 0
+    # Round trips: when each replica last arrived at the bottom after visiting the top,
+    # and whether it has visited the top since
+    self.trip_start = np.full(self.m, -1, dtype=np.int64)
+    self.reached_top = np.zeros(self.m, dtype=np.bool_)
+    self.round_trips = []
+
+    self.conns = []
+    self.workers = []
+    for r, T in enumerate(self.Ts):
+      parent, child = multiprocessing.Pipe()
+      worker = multiprocessing.Process(target = replica_worker, args = (child, T, seeds[r], kwargs), daemon = True)
+      worker.start()
+      self.conns.append(parent)
+      self.workers.append(worker)
+    self.n, self.dim, self.volume = self.conns[0].recv()
+    for conn in self.conns[1:]:
+      conn.recv()
+    self.update_round_trips()
+
+  def run(self, n_exchanges):
+    """
+      Runs all replicas in parallel for n_exchanges rounds of exchange_interval steps, each followed by swap attempts
+    """
+
+    for _ in range(n_exchanges):
+      for r, conn in enumerate(self.conns):
+        conn.send(('run', self.exchange_interval, self.pending_T[r]))
+        self.pending_T[r] = None
+      for r, conn in enumerate(self.conns):
+        self.epot[r], count, sums = conn.recv()
+        self.count[self.slot_of[r]] += count
+        self.sums[self.slot_of[r]] += sums
+      self.step += self.exchange_interval
+      self.attempt_swaps()
+
+  def attempt_swaps(self):
+    """
+      Metropolis swap attempts between the neighbouring slots of one parity, alternating every round
+    """
+
+    for k in range(self.exchanges % 2, self.m - 1, 2):
+      a, b = self.replica_at[k], self.replica_at[k + 1]
+      delta = (1.0 / self.Ts[k] - 1.0 / self.Ts[k + 1]) * (self.epot[a] - self.epot[b])
+      self.attempts[k] += 1
+      if delta >= 0 or self.rng.random() < math.exp(delta):
+        self.accepted[k] += 1
+        self.replica_at[k], self.replica_at[k + 1] = b, a
+        self.slot_of[a], self.slot_of[b] = k + 1, k
+        self.pending_T[a] = self.Ts[k + 1]
+        self.pending_T[b] = self.Ts[k]
+    self.exchanges += 1
+    self.update_round_trips()
+
+  def update_round_trips(self):
+    for r in range(self.m):
+      if self.slot_of[r] == 0:
+        if self.reached_top[r]:
+          self.round_trips.append(int(self.step - self.trip_start[r]))
+          self.reached_top[r] = False
+          self.trip_start[r] = self.step
+        elif self.trip_start[r] < 0:
+          self.trip_start[r] = self.step
+      elif self.slot_of[r] == self.m - 1 and self.trip_start[r] >= 0:
+        self.reached_top[r] = True
+
+  def acceptance_rates(self):
+    """
+      Fraction of accepted swaps between slots k and k+1
+    """
+
+    return self.accepted / np.maximum(self.attempts, 1)
+
+  def mean_round_trip(self):
+    """
+      Mean round trip time in MD steps (nan before the first completed trip)
+    """
+
+    return np.mean(self.round_trips) if self.round_trips else np.nan
+
+  def averages(self):
+    """
+      One row per temperature with the averages of the samples taken there
+    """
+
+    rows = []
+    for k, T in enumerate(self.Ts):
+      Ekin, Epot, Virial, Etot2 = self.sums[k] / max(self.count[k], 1)
+      Etot = Ekin + Epot
+      rows.append({'T': T, 'samples': self.count[k], 'EkinAv': Ekin, 'EpotAv': Epot, 'EtotAv': Etot,
+        'VirialAv': Virial, 'Cv': (Etot2 - Etot * Etot) / (T * T),
+        'P': (2.0 / (self.dim * self.volume)) * (Ekin - Virial)})
+    return rows
+
+  def report(self):
+    for k in range(self.m - 1):
+      print(f'T = {self.Ts[k]:.3g} <-> {self.Ts[k + 1]:.3g}: acceptance {self.acceptance_rates()[k]:.2f}')
+    print(f'{len(self.round_trips)} round trips, mean {self.mean_round_trip():.0f} steps')
+
+  def close(self):
+    for conn, worker in zip(self.conns, self.workers):
+      conn.send(('stop',))
+      worker.join()
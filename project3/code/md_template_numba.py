@@ -2,6 +2,8 @@
 # BH, OF, MP, AJ, TS 2022-11-20, latest verson 2021-10-21
 
 import math
+import os
+import time
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -12,6 +14,15 @@ import random as rnd
 # Since this is by far the most expensive part of the code, it is 'wrapped aside'
 # and accelerated using numba (https://numba.pydata.org/numba-doc/latest/user/5minguide.html)
 import md_force_calculator as md
+import md_thermostat as mt
+import md_initial as mi
+from md_trajectory import TrajectoryWriter
+from md_render import FrameRenderer
+from md_blocking import BlockAverager
+from md_structure import PairCorrelation
+from md_correlators import MultipleTauCorrelator
+from md_profiling import Profiler
+import numba as nmb
 
 """
 
@@ -47,6 +58,7 @@ class MDsimulator:
 
   def __init__(self, 
     n = 48, 
+    dim = 2,
     mass = 1.0, 
     numPerRow = 8, 
     initial_spacing = 1.12,
@@ -56,47 +68,227 @@ class MDsimulator:
     numStepsPerFrame = 100,
     startStepForAveraging = 100,
     thermalize = False,
-    thermalize_n = 10
+    thermalize_n = 10,
+    force_method = 'all_pairs',
+    rc = None,
+    potential = None,
+    skin = 0.3,
+    steps_in_kernel = False,
+    parallel = False,
+    nblocks = None,
+    seed = None,
+    verbose = True,
+    trajectory = None,
+    trajectory_stride = 100,
+    checkpoint = None,
+    checkpoint_interval = 10000,
+    thermostat = None,
+    thermostat_interval = None,
+    thermostat_param = None,
+    rdf_bins = None,
+    rdf_rmax = None,
+    dtype = np.float64,
+    drift_window = None,
+    drift_tolerance = 1e-3,
+    dt_min = None,
+    dt_max = None,
+    density = None,
+    lattice = None,
+    min_distance = 0.9,
+    render = None,
+    render_stride = 100,
+    correlation_stride = None,
+    correlation_points = 16,
+    profile = False,
+    profile_interval = 16
     ):
     """
         This is the class 'constructor'; if you want to try different simulations with different parameters 
         (e.g. temperature, initial particle spacing) in the same scrip, allocate another simulator by passing 
         a different value as input argument. See the examples at the end of the script.
+
+        density sets the box from the number density instead of numPerRow*initial_spacing.
+        lattice chooses the initial positions (see md_initial): 'square', 'triangular' (fcc in 3D)
+        or 'random', random sequential insertion with no pair closer than min_distance. By default
+        the original rows are used, or 'triangular' if density is given.
+
+        dim is 2 or 3. Positions, velocities and forces are stored as (n, dim) arrays
+        pos, vel and force, which the compiled kernels work on directly. dtype is their
+        floating point type: np.float32 halves the memory traffic of large systems, while
+        separations, pair energies, the energy and virial sums and the propagation arithmetic
+        stay in float64 (see validate_precision for the effect on the energy drift).
+
+        force_method selects the force kernel: 'all_pairs' loops over every pair (O(n^2)),
+        'neighbor_list' uses a Verlet list of radius rc + skin, rebuilt whenever a particle
+        has moved more than skin/2. rc is the interaction cutoff (None means no cutoff for
+        'all_pairs' and defaults to 2.5 for 'neighbor_list').
+
+        potential is a md.PairPotential, e.g. md.lennard_jones(2.5, shift=True) or
+        md.tabulated(energy_fn, 2.5). By default the plain Lennard-Jones potential cut at rc is used,
+        otherwise rc is taken from the potential.
+
+        With steps_in_kernel, integrate_some_steps advances a whole frame inside one compiled
+        kernel (md.run_md_steps) instead of calling md_step once per step.
+
+        parallel uses the multi-threaded force kernels. The pair work is split into nblocks
+        blocks (default: numba's thread count); results are bitwise reproducible for a fixed nblocks.
+
+        thermostat is None (NVE), 'andersen', 'berendsen' or 'langevin' (see md_thermostat);
+        thermalize = True is the same as 'andersen'. thermostat_interval is the number of steps
+        between applications (default N_STEPS_THERMO for Andersen, 1 otherwise) and thermostat_param
+        the collision probability (Andersen, default 1), relaxation time (Berendsen, default 0.1)
+        or friction (Langevin, default 1).
+
+        seed seeds the random number stream of this simulator, verbose = False silences
+        the periodic Cv and P output.
+
+        trajectory is a filename (or md_trajectory.TrajectoryWriter) that pos and vel are streamed to
+        every trajectory_stride steps; read it back with md_trajectory.read_trajectory.
+        The velocities stored are the half step velocities the integrator holds after the drift.
+
+        render is a filename (or md_render.FrameRenderer) that a picture of the particles is drawn to
+        every render_stride steps, in a background thread: an image sequence for names like
+        'frames/md_%05d.png', a video (through ffmpeg) otherwise.
+
+        correlation_stride enables the velocity autocorrelation self.vacf and the mean squared
+        displacement self.msd (md_correlators.MultipleTauCorrelator with correlation_points points
+        per level), sampled every correlation_stride steps after startStepForAveraging; see
+        correlations. The displacement uses unwrapped positions (self.unwrapped), followed through
+        the periodic wrap by the minimum image of the moves between samples, so no particle may move
+        more than half the box within correlation_stride steps. The lags assume a constant dt.
+
+        profile times the phases of the loop (forces, neighbor list, thermostat, propagation,
+        averaging, output, ...) and counts steps, pair interactions and neighbor list rebuilds
+        in self.profile, a md_profiling.Profiler; the phases within a step are sampled every
+        profile_interval steps to keep the overhead low. simulate starts it afresh and returns
+        its record, which it also keeps in self.timing. With steps_in_kernel the compiled steps are timed as one 'kernel' phase.
+
+        checkpoint is a filename the full state is saved to every checkpoint_interval steps
+        (at the end of the frame reaching it). To restart, create the simulator with the same
+        arguments, call load_checkpoint and simulate; the run continues bit for bit. The trajectory
+        and an image sequence render continue after the frames written up to the checkpoint.
+
+        rdf_bins enables the pair correlation g(r) (and S(k)) in self.rdf, a
+        md_structure.PairCorrelation with rdf_bins bins up to rdf_rmax. The force kernels fill it
+        at every averaged step. rdf_rmax defaults to the cutoff for 'neighbor_list', which only
+        sees pairs up to there, and to half the box for 'all_pairs'.
+
+        drift_window enables the energy drift watchdog for NVE runs: after every frame the
+        relative drift of Etot over the last drift_window frames (least squares change over the
+        window divided by the mean |Etot|) is compared to drift_tolerance. Above it, dt is halved,
+        but not below dt_min; if dt is already at dt_min (or dt_min is None) the run is aborted.
+        With dt_max, dt grows by 25% (up to dt_max) while the drift stays below drift_tolerance/8.
+        Every change is recorded in dt_history as (step, dt), an abort sets aborted.
     """
 
-    self.theramlize = thermalize
+    if thermostat is None and thermalize:
+      thermostat = 'andersen'
+    if thermostat not in mt.THERMOSTATS:
+      raise ValueError(f'Unknown thermostat {thermostat!r}')
+    if thermostat_interval is None:
+      thermostat_interval = N_STEPS_THERMO if thermostat == 'andersen' else 1
+    if thermostat_param is None:
+      thermostat_param = {None: 0.0, 'andersen': 1.0, 'berendsen': 0.1, 'langevin': 1.0}[thermostat]
+    self.thermostat = thermostat
+    self.thermostat_code = mt.THERMOSTATS[thermostat]
+    self.thermostat_interval = thermostat_interval
+    self.thermostat_param = thermostat_param
+    self.rng = mt.make_rng(seed)
 
     # Initialize simulation parameters and box
+    if dim not in (2, 3):
+      raise ValueError(f'dim must be 2 or 3, not {dim}')
     self.n = n
+    self.dim = dim
     self.mass = 1.0
     self.invmass = 1.0/mass
     self.numPerRow = numPerRow
-    self.Lx = numPerRow*initial_spacing
-    self.Ly = numPerRow*initial_spacing
-    self.area = self.Lx*self.Ly
+    if density is not None:
+      self.L = mi.box_for_density(n, density, dim)
+    else:
+      self.L = np.full(dim, numPerRow*initial_spacing)
+    self.invL = 1.0/self.L
+    self.Lx = self.L[0]
+    self.Ly = self.L[1]
+    self.volume = np.prod(self.L)
+    # Area in 2D, volume in 3D
+    self.area = self.volume
     self.T = T
     self.kBT = kB*T
     self.dt = dt
+    self.initial_dt = dt
+    # Energy drift watchdog
+    self.drift_window = drift_window
+    self.drift_tolerance = drift_tolerance
+    self.dt_min = dt_min
+    self.dt_max = dt_max
+    self.dt_history = [(0, dt)]
+    self.dt_time = 0.0
+    self.drift_start = 0
+    self.kick_correction = 0.0
+    self.aborted = False
     self.nsteps = nsteps
     self.numStepsPerFrame = numStepsPerFrame
+    # Force kernel selection and cutoff
+    if force_method not in ('all_pairs', 'neighbor_list'):
+      raise ValueError(f'Unknown force_method {force_method!r}')
+    self.force_method = force_method
+    if potential is None:
+      if rc is None:
+        rc = 2.5 if force_method == 'neighbor_list' else math.inf
+      potential = md.lennard_jones(rc)
+    if force_method == 'neighbor_list' and potential.rc == math.inf:
+      raise ValueError('The neighbor list needs a potential with a finite cutoff')
+    self.potential = potential
+    self.rc = potential.rc
+    self.skin = skin
+    self.nlist_start = None
+    self.nlist_nbrs = None
+    self.nlist_rebuilds = 0
+    self.steps_in_kernel = steps_in_kernel
+    self.parallel = parallel
+    self.nblocks = nblocks if nblocks is not None else nmb.get_num_threads()
+    # Only the variant of md.run_md_steps picked here gets compiled
+    self.kernels = md.select_step_kernels(dim, force_method, parallel, thermostat == 'langevin')
+    self.verbose = verbose
+    if isinstance(trajectory, str):
+      trajectory = TrajectoryWriter(trajectory, n, dim)
+    self.trajectory = trajectory
+    self.trajectory_stride = trajectory_stride
+    if isinstance(render, str):
+      render = FrameRenderer(render, self.L, n)
+    self.render = render
+    self.render_stride = render_stride
+    self.checkpoint = checkpoint
+    self.checkpoint_interval = checkpoint_interval
     # Initialize positions, velocities and forces
-    self.x = []
-    self.y = []
-    for i in range (n):
-      self.x.append(self.Lx*0.95/numPerRow*((i % numPerRow) + 0.5*(i/numPerRow)))
-      self.y.append(self.Lx*0.95/numPerRow*0.87*(i/numPerRow))
-    
     # Numba likes numpy arrays much more than list
     # Numpy arrays are mutable, so can be passed 'by reference' to quick_force_calculation
-    self.x = np.array(self.x)
-    self.y = np.array(self.y)
-    self.vx = np.zeros(n, dtype=float)
-    self.vy = np.zeros(n, dtype=float)
-    self.fx = np.zeros(n, dtype=float)
-    self.fy = np.zeros(n, dtype=float)
+    self.dtype = dtype
+    self.pos = np.zeros((n, dim), dtype=dtype)
+    if lattice is None and density is not None:
+      lattice = 'triangular'
+    if lattice == 'square':
+      self.pos[:] = mi.square_lattice(n, self.L)
+    elif lattice == 'triangular':
+      self.pos[:] = mi.triangular_lattice(n, self.L)
+    elif lattice == 'random':
+      self.pos[:] = mi.random_sequential_insertion(n, self.L, min_distance, self.rng)
+    elif lattice is not None:
+      raise ValueError(f'Unknown lattice {lattice!r}')
+    else:
+      spacing = self.Lx*0.95/numPerRow
+      for i in range (n):
+        if dim == 2:
+          self.pos[i, 0] = spacing*((i % numPerRow) + 0.5*(i/numPerRow))
+          self.pos[i, 1] = spacing*0.87*(i/numPerRow)
+        else:
+          self.pos[i] = spacing*(np.array([i % numPerRow, (i // numPerRow) % numPerRow, i // numPerRow**2]) + 0.5)
+    self.vel = np.zeros((n, dim), dtype=dtype)
+    self.force = np.zeros((n, dim), dtype=dtype)
 
     # Initialize particles' velocity according to the initial temperature
-    md.thermalize(self.vx, self.vy, np.sqrt(self.kBT/self.mass))
+    mt.draw_velocities(self.vel, np.sqrt(self.kBT/self.mass), self.rng)
     # Initialize containers for energies
     self.sumEkin = 0
     self.sumEpot = 0
@@ -114,6 +306,27 @@ class MDsimulator:
     self.Virial = 0
     self.Cv = 0
     self.P = 0
+    # Block averages of [Ekin, Epot, Virial, Etot^2] for error estimates
+    self.blocks = BlockAverager(4)
+    # Pair correlation, sampled inside the force kernels
+    self.rdf = None
+    # Time correlations, sampled every correlation_stride steps
+    self.correlation_stride = correlation_stride
+    self.vacf = None
+    self.msd = None
+    self.unwrapped = None
+    if correlation_stride is not None:
+      self.vacf = MultipleTauCorrelator(n, dim, product = True, p = correlation_points)
+      self.msd = MultipleTauCorrelator(n, dim, product = False, p = correlation_points)
+    if rdf_bins is not None:
+      if rdf_rmax is None:
+        rdf_rmax = self.rc if force_method == 'neighbor_list' else 0.5 * self.L.min()
+      if force_method == 'neighbor_list' and rdf_rmax > self.rc:
+        raise ValueError('The neighbor list only has the pairs up to rc, rdf_rmax must not exceed it')
+      self.rdf = PairCorrelation(rdf_rmax, rdf_bins, n, self.L)
+    # Per phase timing
+    self.profile = Profiler(profile_interval) if profile else None
+    self.timing = None
 
   def clear_energy_potential(self):
     """
@@ -124,19 +337,70 @@ class MDsimulator:
     self.Epot = 0
     self.Ekin = 0
     self.Virial = 0
-    for i in range(0, self.n):
-      self.fx[i] = 0
-      self.fy[i] = 0
+    self.force.fill(0)
+
+  def build_neighbor_list(self):
+    """
+      Rebuilds the Verlet neighbor list and stores the reference positions
+      used to decide when the next rebuild is needed
+    """
+
+    if self.profile is not None:
+      self.profile.lap('steps')
+    self.nlist_start, self.nlist_nbrs = md.build_neighbor_list(self.pos, self.L, self.rc + self.skin)
+    self.nlist_pos = self.pos.copy()
+    self.nlist_rebuilds += 1
+    if self.profile is not None:
+      self.profile.nlist_rebuilds += 1
+      self.profile.lap('neighbor_list')
+
+  def sampled_histogram(self):
+    """
+      The histogram and inverse bin width the force kernels count pair distances into,
+      empty unless g(r) is sampled at this step
+    """
+
+    if self.rdf is None or self.step <= self.startStepForAveraging:
+      return md.NO_HISTOGRAM, 0.0
+    self.rdf.samples += 1
+    return self.rdf.hist, self.rdf.scale
+
+  def neighbor_list_outdated(self):
+    """
+      True if there is no list yet or some particle moved more than skin/2 since the last build
+    """
+
+    if self.nlist_start is None:
+      return True
+    dmax2 = md.max_displacement2(self.pos, self.nlist_pos, self.L)
+    return dmax2 > 0.25*self.skin*self.skin
 
   def update_forces(self):
     """
-      Updates forces and potential energy using functions
-      pairEnergy and pairForce (which you coded above...)
+      Updates forces and potential energy using the pair potential
+      (by default Lennard-Jones, see md.lennard_jones)
     """
     
-    tEpot, tVirial = md.quick_force_calculation(self.x, self.y, self.fx, self.fy, self.Lx, self.Ly, self.n)
+    hist, scale = self.sampled_histogram()
+    if self.force_method == 'neighbor_list':
+      if self.neighbor_list_outdated():
+        self.build_neighbor_list()
+      if self.parallel:
+        tEpot, tVirial = md.parallel_neighbor_force_calculation(self.pos, self.force, self.L,
+          self.n, self.nlist_start, self.nlist_nbrs, self.potential.pair, self.potential.params, hist, scale, self.nblocks)
+      else:
+        tEpot, tVirial = md.neighbor_force_calculation(self.pos, self.force, self.L, self.n,
+          self.nlist_start, self.nlist_nbrs, self.potential.pair, self.potential.params, hist, scale)
+    elif self.parallel:
+      tEpot, tVirial = md.parallel_force_calculation(self.pos, self.force, self.L, self.n,
+        self.potential.pair, self.potential.params, hist, scale, self.nblocks)
+    else:
+      tEpot, tVirial = md.quick_force_calculation(self.pos, self.force, self.L, self.n,
+        self.potential.pair, self.potential.params, hist, scale)
     self.Epot += tEpot
     self.Virial += tVirial
+    if self.profile is not None:
+      self.profile.pair_interactions += len(self.nlist_nbrs) if self.force_method == 'neighbor_list' else self.n*(self.n - 1)//2
   
   def propagate(self):
     """
@@ -145,31 +409,30 @@ class MDsimulator:
       (THE LATTER YOU NEED TO IMPLEMENT!)
     """
 
-    # TODO
-    # When using a thermostat, modify the velocities of all particles here.
-    # Note that you can use thermalize() from md_force_calculator.py.
-
-    if self.theramlize and (self.step + 1) % N_STEPS_THERMO == 0:
-      md.thermalize(self.vx, self.vy, np.sqrt(self.kBT / self.mass))
-
-    for i in range(0,self.n):
-      # At the first step we alread have the "full step" velocity
-      if self.step > 0:
-        # Update the velocities with a half step
-        self.vx[i] += self.fx[i]*self.invmass*0.5*self.dt
-        self.vy[i] += self.fy[i]*self.invmass*0.5*self.dt
-
-      # Add the kinetic energy of particle i to the total
-      self.Ekin += 0.5*self.mass*(self.vx[i]*self.vx[i] + self.vy[i]*self.vy[i])
-      # Update the velocities with a half step
-      self.vx[i] += self.fx[i]*self.invmass*0.5*self.dt
-      self.vy[i] += self.fy[i]*self.invmass*0.5*self.dt
-      # Update the coordinates
-      self.x[i] += self.vx[i] * self.dt
-      self.y[i] += self.vy[i] * self.dt
-      # Apply p.c.b. and put particles back in the unit cell
-      self.x[i] = self.x[i] % self.Lx
-      self.y[i] = self.y[i] % self.Ly
+    # The previous step kicked by half its dt, but closing with the new dt would only add
+    # half the new one, so the difference is added with the current forces (see change_dt)
+    if self.kick_correction != 0:
+      self.vel += self.kick_correction*self.invmass*self.force
+      self.kick_correction = 0.0
+
+    # Andersen and Berendsen act on the velocities between steps
+    # Whether one is due is checked here, as passing the Generator into compiled code alone
+    # costs several times a velocity Verlet pass of a small system
+    if (self.thermostat_code in (mt.ANDERSEN, mt.BERENDSEN) and self.thermostat_interval > 0
+        and (self.step + 1) % self.thermostat_interval == 0):
+      mt.apply_thermostat(self.thermostat_code, self.thermostat_interval, self.thermostat_param, self.step,
+        self.vel, self.mass, self.kBT, self.dt, self.rng)
+    if self.profile is not None and self.step % self.profile.sample_interval == 0:
+      self.profile.lap('thermostat')
+
+    # Half kicks, drift and p.b.c. for all particles in one compiled pass
+    # At the first step we already have the "full step" velocity
+    if self.thermostat == 'langevin':
+      self.Ekin += mt.propagate_baoab(self.pos, self.vel, self.force,
+        self.mass, self.invmass, self.dt, self.L, self.step == 0, self.thermostat_param, self.kBT, self.rng)
+    else:
+      self.Ekin += md.propagate_velocity_verlet(self.pos, self.vel, self.force,
+        self.mass, self.invmass, self.dt, self.L, self.step == 0)
 
   def md_step(self):
     """
@@ -178,17 +441,160 @@ class MDsimulator:
     """
 
     # This function performs one MD integration step
+    profile = self.profile
+    timed = profile is not None and self.step % profile.sample_interval == 0
+    if timed:
+      profile.lap('steps')
     self.clear_energy_potential()
     self.update_forces()
+    if timed:
+      profile.lap('forces')
+    self.propagate()
+    if timed:
+      profile.lap('propagate')
     # Start averaging only after some initial spin-up time
+    # propagate computes Ekin of this step, so the sums come after it
     if self.step > self.startStepForAveraging:
+      Etot = self.Ekin + self.Epot
       self.sumVirial += self.Virial
       self.sumEkin   += self.Ekin
       self.sumEpot   += self.Epot
-      self.sumEtot   += self.Epot+self.Ekin
-      self.sumEtot2  += (self.Epot+self.Ekin)*(self.Epot+self.Ekin)
-    self.propagate()
+      self.sumEtot   += Etot
+      self.sumEtot2  += Etot*Etot
+      self.blocks.add(np.array([[self.Ekin, self.Epot, self.Virial, Etot*Etot]]))
+    if timed:
+      profile.lap('averaging')
+    if profile is not None:
+      profile.steps += 1
     self.step += 1
+    self.write_frames()
+
+  def steps_to_next_frame(self):
+    """
+      Number of steps until the next trajectory, render or correlation sample, None without any
+    """
+
+    strides = [stride for output, stride in [(self.trajectory, self.trajectory_stride),
+      (self.render, self.render_stride), (self.vacf, self.correlation_stride)] if output is not None]
+    return min((stride - self.step % stride for stride in strides), default=None)
+
+  def write_frames(self):
+    """
+      Appends the current state to the trajectory, if any, every trajectory_stride steps,
+      hands the positions to the renderer every render_stride steps
+      and samples the correlators every correlation_stride steps
+    """
+
+    write_trajectory = self.trajectory is not None and self.step % self.trajectory_stride == 0
+    write_render = self.render is not None and self.step % self.render_stride == 0
+    sample = (self.vacf is not None and self.step > self.startStepForAveraging
+      and self.step % self.correlation_stride == 0)
+    if not (write_trajectory or write_render or sample):
+      return
+    if self.profile is not None:
+      self.profile.lap('steps')
+    if write_trajectory:
+      self.trajectory.append(self.pos, self.vel)
+    if write_render:
+      self.render.append(self.pos)
+    if sample:
+      self.sample_correlations()
+    if self.profile is not None:
+      self.profile.lap('output')
+
+  def sample_correlations(self):
+    """
+      Follows the unwrapped positions to the current step and adds velocities and positions to the correlators
+    """
+
+    if self.unwrapped is None:
+      self.unwrapped = self.pos.astype(float)
+    else:
+      self.unwrapped += md.minimum_image(self.pos - self.unwrap_pos, self.L, self.invL)
+    self.unwrap_pos = self.pos.copy()
+    self.vacf.add(self.vel)
+    self.msd.add(self.unwrapped)
+
+  def correlations(self):
+    """
+      Returns the lag times, the velocity autocorrelation <v(0).v(t)> and the mean squared
+      displacement per particle, and the diffusion constants from the integral of the
+      velocity autocorrelation and from the slope of the last half of the mean squared displacement
+    """
+
+    lags, vacf = self.vacf.result()
+    msd = self.msd.result()[1]
+    t = lags * self.correlation_stride * self.dt
+    D_vacf = np.sum(0.5 * (vacf[1:] + vacf[:-1]) * np.diff(t)) / self.dim
+    half = t >= 0.5 * t[-1]
+    D_msd = np.polyfit(t[half], msd[half], 1)[0] / (2 * self.dim)
+    return {'t': t, 'vacf': vacf, 'msd': msd, 'D_vacf': D_vacf, 'D_msd': D_msd}
+
+  def md_steps_in_kernel(self, nsteps):
+    """
+      Performs nsteps full MD steps inside a single compiled kernel
+      Same result as calling md_step nsteps times
+      The kernel returns at every trajectory, render and correlation sample
+    """
+
+    # The first step after a dt change needs the kick correction done in propagate
+    if self.kick_correction != 0 and nsteps > 0:
+      self.md_step()
+      nsteps -= 1
+    while nsteps > 0:
+      k = nsteps
+      k_frame = self.steps_to_next_frame()
+      if k_frame is not None:
+        k = min(k, k_frame)
+      self.run_kernel_steps(k)
+      nsteps -= k
+      self.write_frames()
+
+  def run_kernel_steps(self, nsteps):
+    """
+      Runs md.run_md_steps for nsteps steps and copies its results back
+    """
+
+    use_nlist = self.force_method == 'neighbor_list'
+    if use_nlist:
+      if self.nlist_start is None:
+        self.build_neighbor_list()
+      start, nbrs, ref = self.nlist_start, self.nlist_nbrs, self.nlist_pos
+    else:
+      start = nbrs = np.zeros(0, dtype=np.int64)
+      ref = np.zeros((0, self.dim), dtype=self.dtype)
+    sums = np.array([self.sumVirial, self.sumEkin, self.sumEpot, self.sumEtot, self.sumEtot2], dtype=float)
+    samples = np.empty((nsteps, 4))
+    if self.rdf is not None:
+      hist, scale = self.rdf.hist, self.rdf.scale
+    else:
+      hist, scale = md.NO_HISTOGRAM, 0.0
+
+    self.Epot, self.Ekin, self.Virial, start, nbrs, rebuilds, pairs = md.run_md_steps(
+      self.pos, self.vel, self.force, self.mass, self.invmass, self.dt, self.L,
+      self.potential.pair, self.potential.params, self.rc,
+      self.kBT, self.thermostat_code, self.thermostat_interval, self.thermostat_param, self.rng,
+      self.step, nsteps, self.startStepForAveraging, sums,
+      *self.kernels, self.skin, start, nbrs, ref, self.nblocks, samples,
+      hist, scale)
+    if self.profile is not None:
+      self.profile.lap('kernel')
+      self.profile.steps += nsteps
+      self.profile.pair_interactions += pairs
+      self.profile.nlist_rebuilds += rebuilds
+
+    self.sumVirial, self.sumEkin, self.sumEpot, self.sumEtot, self.sumEtot2 = sums
+    first = max(self.startStepForAveraging + 1 - self.step, 0)
+    if first < nsteps:
+      self.blocks.add(samples[first:])
+      if self.rdf is not None:
+        self.rdf.samples += nsteps - first
+    if use_nlist:
+      self.nlist_start, self.nlist_nbrs = start, nbrs
+      self.nlist_rebuilds += rebuilds
+    self.step += nsteps
+    if self.profile is not None:
+      self.profile.lap('averaging')
 
   def integrate_some_steps(self, framenr=None):
     """
@@ -196,21 +602,147 @@ class MDsimulator:
       Stores energies and heat capacity
     """
 
-    for j in range(self.numStepsPerFrame):
-      self.md_step()
-    t = self.step*self.dt
+    if self.steps_in_kernel:
+      self.md_steps_in_kernel(self.numStepsPerFrame)
+    else:
+      for j in range(self.numStepsPerFrame):
+        self.md_step()
+      if self.profile is not None:
+        self.profile.lap('steps')
+    t = self.time()
     self.outt.append(t)
     self.ekinList.append(self.Ekin)
     self.epotList.append(self.Epot)
     self.etotList.append(self.Epot + self.Ekin)
     if self.step >= self.startStepForAveraging and self.step % N_OUTPUT_HEAT_CAP == 0:
-      EkinAv = self.sumEkin/(self.step + 1 - self.startStepForAveraging)
-      EtotAv = self.sumEtot/(self.step + 1 - self.startStepForAveraging)
-      Etot2Av = self.sumEtot2/(self.step + 1 - self.startStepForAveraging)
-      VirialAV = self.sumVirial/(self.step + 1 - self.startStepForAveraging)
-      self.Cv = (Etot2Av - EtotAv * EtotAv) / (self.kBT * self.T)
-      self.P = (2.0/self.area)*(EkinAv - VirialAV)
-      print('time', t, 'Cv =', self.Cv, 'P = ', self.P)
+      averages = self.averages()
+      self.Cv = averages['Cv']
+      self.P = averages['P']
+      if self.verbose:
+        print('time', t, 'Cv =', self.Cv, 'P = ', self.P)
+    if self.profile is not None:
+      self.profile.lap('frame')
+
+  def averages(self):
+    """
+      Energy and virial averages since startStepForAveraging,
+      and the heat capacity and pressure derived from them
+    """
+
+    # The steps after startStepForAveraging, up to the last one done (self.step - 1)
+    count = max(self.step - 1 - self.startStepForAveraging, 1)
+    EkinAv = self.sumEkin/count
+    EpotAv = self.sumEpot/count
+    EtotAv = self.sumEtot/count
+    Etot2Av = self.sumEtot2/count
+    VirialAV = self.sumVirial/count
+    return {
+      'EkinAv': EkinAv,
+      'EpotAv': EpotAv,
+      'EtotAv': EtotAv,
+      'VirialAv': VirialAV,
+      'Cv': (Etot2Av - EtotAv * EtotAv) / (self.kBT * self.T),
+      'P': self.pressure(EkinAv, VirialAV)
+    }
+
+  def pressure(self, Ekin, Virial):
+    """
+      Pressure from the kinetic energy and virial by the virial theorem,
+      P V = (2/dim)*(Ekin - Virial) with Virial = -(1/2) sum over pairs of r*f
+    """
+
+    return (2.0/(self.dim*self.volume))*(Ekin - Virial)
+
+  def block_estimates(self):
+    """
+      Averages with blocking error estimates, as {name: (value, error)}
+    """
+
+    Ekin, Epot, Virial, Etot2 = self.blocks.mean()
+    Etot = Ekin + Epot
+    kT2 = self.kBT * self.T
+    # Gradients of each quantity with respect to the means of [Ekin, Epot, Virial, Etot^2]
+    quantities = {
+      'Ekin': (Ekin, [1, 0, 0, 0]),
+      'Epot': (Epot, [0, 1, 0, 0]),
+      'Virial': (Virial, [0, 0, 1, 0]),
+      'Etot': (Etot, [1, 1, 0, 0]),
+      'Cv': ((Etot2 - Etot * Etot) / kT2, [-2 * Etot / kT2, -2 * Etot / kT2, 0, 1 / kT2]),
+      'P': (self.pressure(Ekin, Virial), [self.pressure(1, 0), 0, self.pressure(0, 1), 0])
+    }
+    return {name: (value, self.blocks.error(gradient)) for name, (value, gradient) in quantities.items()}
+
+  def converged(self, target_errors):
+    """
+      True when the blocking error of every quantity in target_errors ({name: error}) is below its target
+    """
+
+    estimates = self.block_estimates()
+    return all(estimates[name][1] <= target for name, target in target_errors.items())
+
+  def energy_drift(self):
+    """
+      Least squares slope of the total energy per particle against time,
+      over the frames recorded in etotList
+    """
+
+    if len(self.outt) < 2:
+      return 0.0
+    return np.polyfit(self.outt, self.etotList, 1)[0] / self.n
+
+  def relative_drift(self, frames):
+    """
+      Change of Etot over the last frames frames from a least squares line, relative to the mean |Etot|
+    """
+
+    t = np.array(self.outt[-frames:])
+    etot = np.array(self.etotList[-frames:])
+    slope = np.polyfit(t, etot, 1)[0]
+    return abs(slope * (t[-1] - t[0])) / np.abs(etot).mean()
+
+  def time(self):
+    """
+      Simulated time, counted in steps of the current dt since the last dt change
+    """
+
+    return self.dt_time + (self.step - self.dt_history[-1][0])*self.dt
+
+  def change_dt(self, dt):
+    """
+      Continues with time step dt from the next step on. The stored velocities have had the
+      opening half kick of the old dt, so the next closing half kick is corrected to match.
+    """
+
+    self.kick_correction = 0.5*(self.dt - dt)
+    self.dt_time = self.time()
+    self.dt = dt
+    self.dt_history.append((self.step, dt))
+    self.drift_start = len(self.etotList)
+
+  def check_energy_drift(self):
+    """
+      Energy drift watchdog, called after every frame: shrinks, grows or keeps dt
+      depending on the drift over the last drift_window frames at the current dt.
+      Returns False if the run has to be aborted.
+    """
+
+    if self.drift_window is None or len(self.etotList) - self.drift_start < self.drift_window:
+      return True
+    drift = self.relative_drift(self.drift_window)
+    if not drift <= self.drift_tolerance: # also catches a blown up (nan) energy
+      if self.dt_min is None or self.dt <= self.dt_min:
+        self.aborted = True
+        if self.verbose:
+          print(f'Aborted at step {self.step}: relative energy drift {drift:.2e} with dt = {self.dt}')
+        return False
+      self.change_dt(max(0.5*self.dt, self.dt_min))
+    elif self.dt_max is not None and self.dt < self.dt_max and drift < self.drift_tolerance/8:
+      self.change_dt(min(1.25*self.dt, self.dt_max))
+    else:
+      return True
+    if self.verbose:
+      print(f'Step {self.step}: relative energy drift {drift:.2e}, dt changed to {self.dt}')
+    return True
 
   def snapshot(self, framenr=None):
     """
@@ -219,19 +751,140 @@ class MDsimulator:
     """
 
     self.integrate_some_steps(framenr)
-    return self.ax.scatter(self.x, self.y, s=DISK_SIZE, marker='o', c="r"),
+    # Moving the points of one scatter is much cheaper than making a new one every frame
+    self.scatter.set_offsets(self.pos[:, :2])
+    return self.scatter,
 
-  def simulate(self):
+  def simulate(self, target_errors=None):
     """
       Performs the whole MD simulation
       If the total number of steps is not divisible by the frame size, then
       the simulation will undergo nsteps-(nsteps%numStepsPerFrame) steps
+      With target_errors, e.g. {'Cv': 1, 'P': 0.01}, the simulation stops early
+      once all blocking error estimates are below their targets
+      Returns the timing record (see md_profiling) with profile, None otherwise
     """
 
+    profile = self.profile
+    if profile is not None:
+      profile.start()
     nn = self.nsteps//self.numStepsPerFrame
-    print("Integrating for "+str(nn*self.numStepsPerFrame)+" steps...")
-    for i in range(nn) :
+    if self.verbose:
+      print("Integrating for "+str(nn*self.numStepsPerFrame)+" steps...")
+    # A restored simulation continues from its current frame
+    for i in range(self.step//self.numStepsPerFrame, nn) :
       self.integrate_some_steps()
+      drift_ok = self.check_energy_drift()
+      if profile is not None:
+        profile.lap('frame')
+      if self.checkpoint is not None and self.step % self.checkpoint_interval < self.numStepsPerFrame:
+        self.save_checkpoint(self.checkpoint)
+        if profile is not None:
+          profile.lap('checkpoint')
+      if not drift_ok:
+        break
+      if target_errors is not None and self.converged(target_errors):
+        if self.verbose:
+          print('Converged after', self.step, 'steps')
+        break
+    if self.trajectory is not None:
+      self.trajectory.close()
+    if self.render is not None:
+      self.render.close()
+    if profile is not None:
+      profile.lap('output')
+      self.timing = profile.record()
+      if self.verbose:
+        profile.report()
+    return self.timing
+
+  def save_checkpoint(self, filename):
+    """
+      Saves everything needed to continue the run bit for bit: particle state, step,
+      running sums, energy lists, blocking state, neighbor list and random number state
+      The trajectory and render frames are written out first, and their counts saved
+      The file is written next to the old one and then moved over it, so a crash while
+      writing never leaves a broken checkpoint
+    """
+
+    state = {
+      'n': self.n, 'L': self.L, 'dt': self.initial_dt, 'T': self.T,
+      'current_dt': self.dt, 'dt_time': self.dt_time, 'kick_correction': self.kick_correction,
+      'dt_history': self.dt_history, 'drift_start': self.drift_start, 'aborted': self.aborted,
+      'pos': self.pos, 'vel': self.vel, 'force': self.force,
+      'step': self.step, 'Epot': self.Epot, 'Ekin': self.Ekin, 'Virial': self.Virial, 'Cv': self.Cv, 'P': self.P,
+      'sums': [self.sumVirial, self.sumEkin, self.sumEpot, self.sumEtot, self.sumEtot2],
+      'outt': self.outt, 'ekinList': self.ekinList, 'epotList': self.epotList, 'etotList': self.etotList,
+      'blocks_pending': self.blocks.pending, 'blocks_has_pending': self.blocks.has_pending,
+      'blocks_count': self.blocks.count, 'blocks_sums': self.blocks.sums, 'blocks_sums2': self.blocks.sums2,
+      'nlist_rebuilds': self.nlist_rebuilds
+    }
+    state.update(mt.get_rng_state(self.rng))
+    if self.rdf is not None:
+      state.update(rdf_hist=self.rdf.hist, rdf_samples=self.rdf.samples)
+    if self.vacf is not None:
+      state.update(self.vacf.state('vacf_'))
+      state.update(self.msd.state('msd_'))
+    if self.unwrapped is not None:
+      state.update(unwrapped=self.unwrapped, unwrap_pos=self.unwrap_pos)
+    if self.nlist_start is not None:
+      state.update(nlist_start=self.nlist_start, nlist_nbrs=self.nlist_nbrs, nlist_pos=self.nlist_pos)
+    if self.trajectory is not None:
+      state.update(trajectory_frames=self.trajectory.sync())
+    if self.render is not None:
+      state.update(render_frames=self.render.sync())
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+      np.savez(f, **state)
+    os.replace(tmp, filename)
+
+  def load_checkpoint(self, filename):
+    """
+      Restores the state saved by save_checkpoint into a simulator created with the same arguments
+      The trajectory and render continue after the frames they had at the checkpoint
+    """
+
+    with np.load(filename) as state:
+      for name, value in [('n', self.n), ('L', self.L), ('dt', self.initial_dt), ('T', self.T)]:
+        if not np.array_equal(state[name], value):
+          raise ValueError(f'Checkpoint has {name} = {state[name]}, this simulator {value}')
+
+      for name in ['pos', 'vel', 'force']:
+        getattr(self, name)[:] = state[name]
+      self.step = int(state['step'])
+      self.dt = float(state['current_dt'])
+      self.dt_time = float(state['dt_time'])
+      self.kick_correction = float(state['kick_correction'])
+      self.dt_history = [(int(step), float(dt)) for step, dt in state['dt_history']]
+      self.drift_start = int(state['drift_start'])
+      self.aborted = bool(state['aborted'])
+      for name in ['Epot', 'Ekin', 'Virial', 'Cv', 'P']:
+        setattr(self, name, float(state[name]))
+      self.sumVirial, self.sumEkin, self.sumEpot, self.sumEtot, self.sumEtot2 = (float(v) for v in state['sums'])
+      for name in ['outt', 'ekinList', 'epotList', 'etotList']:
+        setattr(self, name, state[name].tolist())
+      for name in ['pending', 'has_pending', 'count', 'sums', 'sums2']:
+        getattr(self.blocks, name)[:] = state['blocks_' + name]
+      mt.set_rng_state(self.rng, state)
+      self.nlist_rebuilds = int(state['nlist_rebuilds'])
+      if self.rdf is not None:
+        self.rdf.hist[:] = state['rdf_hist']
+        self.rdf.samples = int(state['rdf_samples'])
+      if self.vacf is not None:
+        self.vacf.set_state('vacf_', state)
+        self.msd.set_state('msd_', state)
+      if 'unwrapped' in state:
+        self.unwrapped = state['unwrapped']
+        self.unwrap_pos = state['unwrap_pos']
+      if 'nlist_start' in state:
+        self.nlist_start = state['nlist_start']
+        self.nlist_nbrs = state['nlist_nbrs']
+        self.nlist_pos = state['nlist_pos']
+      if self.trajectory is not None and 'trajectory_frames' in state:
+        self.trajectory.resume(int(state['trajectory_frames']))
+      if self.render is not None and 'render_frames' in state:
+        self.render.resume(int(state['render_frames']))
 
   def simulate_animate(self):
     """
@@ -242,6 +895,7 @@ class MDsimulator:
 
     self.fig = plt.figure()
     self.ax = plt.subplot(xlim=(0, self.Lx), ylim=(0, self.Ly))
+    self.scatter = self.ax.scatter(self.pos[:, 0], self.pos[:, 1], s=DISK_SIZE, marker='o', c="r")
 
     nn = self.nsteps//self.numStepsPerFrame
     print("Integrating for "+str(nn*self.numStepsPerFrame)+" steps...") 
@@ -280,6 +934,14 @@ def exercise_32a():
   molecules.simulate()
   molecules.plot_energy(title = f'Energies with T = {T} and dt = {dt}', filename = f'3_2a_dt{dt_str}')
 
+def exercise_32a_watchdog():
+  # Starts at the magic dt and lets the drift watchdog find a time step that conserves energy
+  T = 1
+  molecules = MDsimulator(T = T, dt = 0.0251, nsteps = 50_000, drift_window = 20, dt_min = 0.001, dt_max = 0.03)
+  molecules.simulate()
+  print('dt history (step, dt):', molecules.dt_history, 'aborted:', molecules.aborted)
+  molecules.plot_energy(title = f'Energies with T = {T}, adaptive dt', filename = '3_2a_watchdog')
+
 def exercise_32b():
   T = 0.2
   molecules = MDsimulator(T = T)
@@ -293,7 +955,7 @@ def exercise_32c():
 
   T_str = str(T).replace('.', '')
   
-  molecules = MDsimulator(T = T, nsteps = n_steps, thermalize = True)
+  molecules = MDsimulator(T = T, nsteps = n_steps, thermalize = True, steps_in_kernel = True)
   molecules.simulate()
   molecules.plot_energy(title = f'Energies with T = {molecules.T}, using Andersen thermostat (n = {N_STEPS_THERMO})', filename = f'../report/img/3_2c_T{T_str}_n{N_STEPS_THERMO}')
 
@@ -330,6 +992,28 @@ def exercise_32d():
   plt.savefig('../report/img/3_2d_ECvvsT.pdf')
   plt.show()
 
+def exercise_32d_tempering():
+  # Same temperatures as exercise_32d, but as replicas exchanging temperatures, which helps the low T ones equilibrate
+  from md_tempering import ParallelTempering
+  from md_ensemble import print_table
+
+  Ts = [i / 10 for i in range(2, 10 + 1)]
+  tempering = ParallelTempering(Ts, exchange_interval = 200, seed = 0)
+  tempering.run(250)
+  tempering.report()
+  rows = tempering.averages()
+  tempering.close()
+  print_table(rows, ['T', 'samples', 'EtotAv', 'Cv', 'P'])
+
+  plt.figure()
+  plt.plot(Ts, [row['EtotAv'] for row in rows], label = 'Average Energy')
+  plt.plot(Ts, [row['Cv'] for row in rows], label = 'Heat Capacity')
+  plt.xlabel('Temperature')
+  plt.ylabel('Average Energy / Heat Capacity')
+  plt.title('Average Energy & Heat Capacity vs Temperature (parallel tempering)')
+  plt.legend()
+  plt.show()
+
 def exercise_32e():
   Ts = [i / 10 for i in range(2, 10 + 1)]
   n_steps = 50_000
@@ -376,42 +1060,326 @@ def exercise_32e():
   plt.show()
 
 def exercise_32e_alt():
+  # All temperatures and sizes are independent, so they run in parallel on all cores
+  from md_ensemble import run_ensemble, print_table
+
   Ts = [i / 10 for i in range(2, 10 + 1)]
   n_steps = 50_000
-  sim_range = range(3, 5 +1)
+  sides = [2 ** i for i in range(3, 5 + 1)]
 
-  P_matrix = [] # Array of arrays
-  ideal_matrix = []
-
-  for T in Ts:
-    print(T)
-    Ps = []
-    ideal_Ps = []
-    for i in sim_range:
-      molecules = MDsimulator(T = T, nsteps = n_steps, thermalize = True, numPerRow = 2 ** i)
-      molecules.simulate()
-      Ps.append(molecules.P)
-      ideal_Ps.append(molecules.n * kB * T / molecules.area)
-    P_matrix.append(Ps)
-    ideal_matrix.append(ideal_Ps)
+  rows = run_ensemble(Ts, numPerRows = sides, nsteps = n_steps, thermalize = True, steps_in_kernel = True)
+  print_table(rows)
 
-  for i in sim_range:
+  for side in sides:
+    Ps = [row['P'] for row in rows if row['numPerRow'] == side]
+    ideal_Ps = [row['n'] * kB * row['T'] / row['area'] for row in rows if row['numPerRow'] == side]
     plt.figure()
-    plt.plot(Ts, P_matrix[i], label = 'Simulation')
-    plt.plot(Ts, ideal_matrix[i], label = 'Ideal Gas Law')
+    plt.plot(Ts, Ps, label = 'Simulation')
+    plt.plot(Ts, ideal_Ps, label = 'Ideal Gas Law')
     plt.xlabel('Temperature')
     plt.ylabel('Pressure')
-    plt.title(f'Pressure vs Temperature\nSide length {2 ** i}')
+    plt.title(f'Pressure vs Temperature\nSide length {side}')
     plt.legend()
-    plt.savefig(f'../report/img/3_2e_PvsT_cont_{2 ** i}.pdf')
+    plt.savefig(f'../report/img/3_2e_PvsT_cont_{side}.pdf')
+    plt.show()
+
+def exercise_diffusion():
+  # Diffusion constant from the velocity autocorrelation and from the mean squared displacement
+  for T in [0.5, 1.0]:
+    molecules = MDsimulator(T = T, nsteps = 50_000, thermalize = True, steps_in_kernel = True, correlation_stride = 5)
+    molecules.simulate()
+    c = molecules.correlations()
+    print(f'T = {T}: D = {c["D_vacf"]:.4f} (VACF), {c["D_msd"]:.4f} (MSD)')
+
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize = (10, 4))
+    ax1.semilogx(c['t'][1:], c['vacf'][1:])
+    ax1.set_xlabel('t')
+    ax1.set_ylabel('<v(0) . v(t)>')
+    ax2.loglog(c['t'][1:], c['msd'][1:])
+    ax2.set_xlabel('t')
+    ax2.set_ylabel('<|r(t) - r(0)|^2>')
+    fig.suptitle(f'Velocity autocorrelation and mean squared displacement, T = {T}')
     plt.show()
 
+def benchmark_neighbor_list():
+  # Same cutoff for both kernels, so energies and virials should agree to round-off
+  molecules = MDsimulator(n = 256, numPerRow = 16, T = 1, rc = 2.5, force_method = 'neighbor_list')
+  force = np.zeros_like(molecules.force)
+  for _ in range(10):
+    for _ in range(100):
+      molecules.md_step()
+    molecules.clear_energy_potential()
+    molecules.update_forces()
+    force[:] = 0
+    Epot, Virial = md.quick_force_calculation(molecules.pos, force, molecules.L, molecules.n,
+      molecules.potential.pair, molecules.potential.params, md.NO_HISTOGRAM, 0.0)
+    print(f'step {molecules.step}: dEpot = {molecules.Epot - Epot:.2e}, dVirial = {molecules.Virial - Virial:.2e},',
+      f'max dF = {np.abs(molecules.force - force).max():.2e}')
+  print('Neighbor list rebuilds:', molecules.nlist_rebuilds)
+
+  # Force time per step should grow linearly with n
+  n_steps = 100
+  for n in [1_000, 4_000, 16_000, 64_000, 100_000]:
+    numPerRow = math.ceil(math.sqrt(n))
+    molecules = MDsimulator(n = n, numPerRow = numPerRow, T = 1, force_method = 'neighbor_list')
+    molecules.md_step() # Compile and build the first list
+    t_force = 0
+    for _ in range(n_steps):
+      molecules.clear_energy_potential()
+      t_start = time.perf_counter()
+      molecules.update_forces()
+      t_force += time.perf_counter() - t_start
+      molecules.propagate()
+      molecules.step += 1
+    print(f'n = {n}: {1e6 * t_force / n_steps:.0f} us per step, {1e9 * t_force / n_steps / n:.0f} ns per particle')
+
+def benchmark_initial():
+  # Time to place 10^5 particles at liquid densities, and a short run from each starting configuration
+  rng = mt.make_rng(0)
+  for d, density, rmin in [(2, 0.7, 0.9), (3, 0.7, 0.8)]:
+    L = mi.box_for_density(100_000, density, d)
+    mi.random_sequential_insertion(10, L, rmin, rng) # Compile
+    for name, place in [('square', lambda: mi.square_lattice(100_000, L)),
+                        ('triangular', lambda: mi.triangular_lattice(100_000, L)),
+                        ('random', lambda: mi.random_sequential_insertion(100_000, L, rmin, rng))]:
+      t_start = time.perf_counter()
+      place()
+      print(f'{d}D {name}: {time.perf_counter() - t_start:.3f} s for 10^5 particles at density {density}')
+
+  for lattice in ['square', 'triangular', 'random']:
+    molecules = MDsimulator(n = 1000, density = 0.7, lattice = lattice, T = 1, nsteps = 2000, seed = 1,
+      force_method = 'neighbor_list', steps_in_kernel = True, verbose = False)
+    molecules.simulate()
+    print(f'{lattice}: Etot per particle from {molecules.etotList[0] / molecules.n:.3f} to {molecules.etotList[-1] / molecules.n:.3f}')
+
+def benchmark_render():
+  # Time per frame of a new matplotlib scatter against rasterizing into the reused image buffer
+  import md_render as mr
+  molecules = MDsimulator(n = 100_000, density = 0.7, T = 1)
+  renderer = mr.FrameRenderer('md_%05d.png', molecules.L, molecules.n, background = False)
+  mr.rasterize(molecules.pos, molecules.L, renderer.image, 0.5, renderer.color, renderer.background_color) # Compile
+  n_frames = 10
+  t_start = time.perf_counter()
+  for _ in range(n_frames):
+    mr.rasterize(molecules.pos, molecules.L, renderer.image, 0.5, renderer.color, renderer.background_color)
+  t_raster = (time.perf_counter() - t_start) / n_frames
+
+  plt.figure()
+  ax = plt.subplot(xlim=(0, molecules.Lx), ylim=(0, molecules.Ly))
+  t_start = time.perf_counter()
+  for _ in range(n_frames):
+    artist = ax.scatter(molecules.pos[:, 0], molecules.pos[:, 1], s=1, marker='o', c="r")
+    plt.gcf().canvas.draw()
+    artist.remove()
+  t_scatter = (time.perf_counter() - t_start) / n_frames
+  plt.close()
+  print(f'n = {molecules.n}: scatter {1e3 * t_scatter:.1f} ms, rasterize {1e3 * t_raster:.1f} ms per frame')
+
+def benchmark_md_step():
+  # Per step cost split between force calculation and propagation
+  n_steps = 2000
+  for numPerRow in [8, 16, 32]:
+    molecules = MDsimulator(n = numPerRow ** 2, numPerRow = numPerRow, T = 1)
+    molecules.md_step() # Compile
+    t_force = 0
+    t_prop = 0
+    for _ in range(n_steps):
+      t_start = time.perf_counter()
+      molecules.clear_energy_potential()
+      molecules.update_forces()
+      t_mid = time.perf_counter()
+      molecules.propagate()
+      molecules.step += 1
+      t_end = time.perf_counter()
+      t_force += t_mid - t_start
+      t_prop += t_end - t_mid
+    print(f'n = {molecules.n}: forces {1e6 * t_force / n_steps:.1f} us, propagate {1e6 * t_prop / n_steps:.1f} us per step')
+
+def benchmark_force_kernels():
+  # Force time per pair for the serial kernels in 2D and 3D
+  # (the original x, y kernels took about 14 ns per pair in 2D for both cases)
+  n_calls = 20
+  for dim, density in [(2, 0.7), (3, 0.8)]:
+    for n, force_method in [(1024, 'all_pairs'), (16000, 'neighbor_list')]:
+      molecules = MDsimulator(n = n, dim = dim, density = density, force_method = force_method, verbose = False)
+      for _ in range(2): # Compile, the second call checks the neighbor list built by the first
+        molecules.clear_energy_potential()
+        molecules.update_forces()
+      t_start = time.perf_counter()
+      for _ in range(n_calls):
+        molecules.clear_energy_potential()
+        molecules.update_forces()
+      t = (time.perf_counter() - t_start) / n_calls
+      pairs = len(molecules.nlist_nbrs) if force_method == 'neighbor_list' else n*(n - 1)//2
+      print(f'{dim}D, {force_method}, n = {n}: {1e3 * t:.2f} ms per force calculation, {1e9 * t / pairs:.1f} ns per pair')
+
+def benchmark_profile():
+  # Where the time goes, per phase, for the Python steps and the compiled kernel
+  for force_method in ['all_pairs', 'neighbor_list']:
+    for steps_in_kernel in [False, True]:
+      print(f'{force_method}, steps_in_kernel = {steps_in_kernel}:')
+      molecules = MDsimulator(n = 400, density = 0.7, T = 1, nsteps = 2000, thermalize = True, force_method = force_method,
+        steps_in_kernel = steps_in_kernel, profile = True, verbose = False)
+      molecules.md_steps_in_kernel(200) # Compile
+      molecules.simulate()
+      molecules.profile.report()
+
+def benchmark_parallel_forces():
+  # Force time per call for increasing thread counts, and reproducibility for a fixed block count
+  n_calls = 20
+  numPerRow = 64
+  molecules = MDsimulator(n = numPerRow ** 2, numPerRow = numPerRow, T = 1, parallel = True)
+  force = np.zeros_like(molecules.force)
+  for n_threads in range(1, nmb.config.NUMBA_NUM_THREADS + 1):
+    nmb.set_num_threads(n_threads)
+    md.parallel_force_calculation(molecules.pos, force, molecules.L, molecules.n, molecules.potential.pair, molecules.potential.params, md.NO_HISTOGRAM, 0.0, n_threads)
+    t_start = time.perf_counter()
+    for _ in range(n_calls):
+      md.parallel_force_calculation(molecules.pos, force, molecules.L, molecules.n, molecules.potential.pair, molecules.potential.params, md.NO_HISTOGRAM, 0.0, n_threads)
+    print(f'{n_threads} threads: {1e3 * (time.perf_counter() - t_start) / n_calls:.2f} ms per force calculation')
+
+  results = []
+  for n_threads in [1, nmb.config.NUMBA_NUM_THREADS]:
+    nmb.set_num_threads(n_threads)
+    force[:] = 0
+    Epot, Virial = md.parallel_force_calculation(molecules.pos, force, molecules.L, molecules.n, molecules.potential.pair, molecules.potential.params, md.NO_HISTOGRAM, 0.0, 8)
+    results.append((Epot, Virial, force.copy()))
+  print('Bitwise identical for 8 blocks on 1 and', nmb.config.NUMBA_NUM_THREADS, 'threads:',
+    results[0][0] == results[1][0] and results[0][1] == results[1][1]
+    and np.array_equal(results[0][2], results[1][2]))
+
+def benchmark_pbc_dist():
+  molecules = MDsimulator(n = 4096, numPerRow = 64)
+  Lx, Ly = molecules.L
+  invLx, invLy = molecules.invL
+  x, y = molecules.pos[:, 0].copy(), molecules.pos[:, 1].copy()
+
+  # Particles exactly on the cell boundary and at half box separations
+  edge = [0.0, 0.5*Lx, Lx, np.nextafter(Lx, 0), np.nextafter(0.5*Lx, Lx)]
+  worst = 0
+  for x1 in edge:
+    for x2 in edge:
+      dx, dy, r = md.pbc_dist(x1, x2, x2, x1, Lx, Ly, invLx, invLy)
+      dx_loop, dy_loop, r_loop = md.pbc_dist_loop(x1, x2, x2, x1, Lx, Ly)
+      # At exactly half a box both images are equally near, so only the magnitude must agree
+      worst = max(worst, abs(abs(dx) - abs(dx_loop)), abs(abs(dy) - abs(dy_loop)), abs(r - r_loop))
+  print('Largest difference for boundary particles:', worst)
+
+  # One particle against a block of neighbors as a single array operation
+  dx, dy, r = md.pbc_dist(x[0], y[0], x[1:], y[1:], Lx, Ly, invLx, invLy)
+  r_loop = np.array([md.pbc_dist_loop(x[0], y[0], x[j], y[j], Lx, Ly)[2]
+    for j in range(1, molecules.n)])
+  print('Largest difference for a block of', molecules.n - 1, 'pairs:', np.abs(r - r_loop).max())
+
+  @nmb.jit(nopython=True)
+  def sum_r_rounding(x, y, Lx, Ly, invLx, invLy):
+    total = 0.0
+    for i in range(len(x)):
+      for j in range(i + 1, len(x)):
+        total += md.pbc_dist(x[i], y[i], x[j], y[j], Lx, Ly, invLx, invLy)[2]
+    return total
+
+  @nmb.jit(nopython=True)
+  def sum_r_loop(x, y, Lx, Ly):
+    total = 0.0
+    for i in range(len(x)):
+      for j in range(i + 1, len(x)):
+        total += md.pbc_dist_loop(x[i], y[i], x[j], y[j], Lx, Ly)[2]
+    return total
+
+  sum_r_rounding(x, y, Lx, Ly, invLx, invLy)
+  sum_r_loop(x, y, Lx, Ly)
+  n_pairs = molecules.n * (molecules.n - 1) // 2
+  t_start = time.perf_counter()
+  sum_r_rounding(x, y, Lx, Ly, invLx, invLy)
+  t_rounding = time.perf_counter() - t_start
+  t_start = time.perf_counter()
+  sum_r_loop(x, y, Lx, Ly)
+  t_loop = time.perf_counter() - t_start
+  print(f'rounding: {1e9 * t_rounding / n_pairs:.2f} ns per pair, loops: {1e9 * t_loop / n_pairs:.2f} ns per pair')
+
+def benchmark_potentials():
+  # Truncated and shifted Lennard-Jones against its tabulated version, from pairEnergy and pairForce
+  lj = md.lennard_jones(2.5, shift=True)
+  table = md.tabulated(md.pairEnergy, 2.5, force=md.pairForce)
+  r = np.linspace(0.9, 2.6, 1000)
+  e_lj, fr_lj = np.array([lj.pair(ri * ri, lj.params) for ri in r]).T
+  e_tab, fr_tab = np.array([table.pair(ri * ri, table.params) for ri in r]).T
+  print('Largest table error: energy', np.abs(e_lj - e_tab).max(), 'force', np.abs((fr_lj - fr_tab) * r).max())
+
+  n_steps = 200
+  for name, potential in [('plain', md.lennard_jones()), ('cut and shifted', lj), ('tabulated', table)]:
+    molecules = MDsimulator(n = 1024, numPerRow = 32, T = 1, potential = potential)
+    molecules.md_step() # Compile
+    t_start = time.perf_counter()
+    for _ in range(n_steps):
+      molecules.md_step()
+    print(f'{name}: {1e3 * (time.perf_counter() - t_start) / n_steps:.2f} ms per step')
+
+def benchmark_rdf():
+  # Cost of sampling g(r) in the force kernel at every step, and g(r), S(k) of a 3D liquid
+  n_steps = 4000
+  runs = {}
+  for bins in [None, 200]:
+    molecules = MDsimulator(n = 512, numPerRow = 8, dim = 3, T = 1, dt = 0.005, nsteps = n_steps, seed = 1,
+      force_method = 'neighbor_list', thermostat = 'langevin', steps_in_kernel = True, verbose = False, rdf_bins = bins)
+    molecules.md_steps_in_kernel(200) # Compile, including the averaging
+    t_start = time.perf_counter()
+    molecules.simulate()
+    runs[bins] = time.perf_counter() - t_start
+  print(f'Overhead of sampling g(r): {100 * (runs[200] / runs[None] - 1):.1f}%')
+
+  r, g = molecules.rdf.g()
+  k = np.linspace(1, 20, 400)
+  plt.subplot(1, 2, 1)
+  plt.plot(r, g)
+  plt.xlabel('r')
+  plt.ylabel('g(r)')
+  plt.subplot(1, 2, 2)
+  plt.plot(k, molecules.rdf.structure_factor(k))
+  plt.xlabel('k')
+  plt.ylabel('S(k)')
+  plt.show()
+
+def validate_precision():
+  # Energy drift of exercise_32a-style NVE runs in float32 against float64, for growing boxes,
+  # and the time per step of both
+  n_steps = 20_000
+  for numPerRow in [8, 32, 64]:
+    drifts = {}
+    for dtype in [np.float64, np.float32]:
+      molecules = MDsimulator(n = numPerRow ** 2, numPerRow = numPerRow, T = 1, dt = 0.01, nsteps = n_steps, seed = 1,
+        force_method = 'neighbor_list', steps_in_kernel = True, verbose = False, dtype = dtype)
+      molecules.md_steps_in_kernel(200) # Compile, including the averaging
+      t_start = time.perf_counter()
+      molecules.simulate()
+      t_step = (time.perf_counter() - t_start) / n_steps
+      etot = np.array(molecules.etotList) / molecules.n
+      drifts[dtype] = molecules.energy_drift()
+      print(f'n = {molecules.n}, {np.dtype(dtype).name}: drift {drifts[dtype]:.2e} per particle and time unit,',
+        f'Etot range {etot.max() - etot.min():.2e}, {1e6 * t_step:.0f} us per step')
+    print(f'  float32 - float64 drift: {drifts[np.float32] - drifts[np.float64]:.2e}')
+
 # Calling 'main()' if the script is executed.
 # If the script is instead just imported, main is not called (this can be useful if you want to
 # write another script importing and utilizing the functions and classes defined in this one)
 if __name__ == "__main__":
   # exercise_32a()
+  # exercise_32a_watchdog()
   # exercise_32b()
   # exercise_32c()
   # exercise_32d()
-  exercise_32e()
\ No newline at end of file
+  # exercise_32d_tempering()
+  exercise_32e()
+  # exercise_diffusion()
+  # benchmark_initial()
+  # benchmark_render()
+  # benchmark_neighbor_list()
+  # benchmark_md_step()
+  # benchmark_force_kernels()
+  # benchmark_profile()
+  # benchmark_parallel_forces()
+  # benchmark_pbc_dist()
+  # benchmark_potentials()
+  # benchmark_rdf()
+  # validate_precision()
\ No newline at end of file
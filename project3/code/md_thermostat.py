@@ -0,0 +1,116 @@
+# Thermostats for MDsimulator
+
+import numpy as np
+import numba as nmb
+
+"""
+    All random numbers come from a numpy Generator on a Philox bit generator. Philox is counter
+    based: every replica seeded differently gets its own independent stream, the stream does not
+    depend on which process or thread runs the replica, and its state is a few integers that can
+    be checkpointed. The same Generator is passed into the compiled code, so the Python and the
+    in-kernel paths draw identical numbers.
+
+    Thermostats (codes as passed to the compiled code):
+      NONE       plain velocity Verlet (NVE)
+      ANDERSEN   every interval steps each particle gets new Gaussian velocities with probability param
+                 (param = 1 redraws all of them, as the original thermalize)
+      BERENDSEN  every interval steps the velocities are scaled towards kBT with relaxation time param
+      LANGEVIN   BAOAB Langevin integration with friction param, applied every step
+"""
+
+NONE = 0
+ANDERSEN = 1
+BERENDSEN = 2
+LANGEVIN = 3
+
+THERMOSTATS = {None: NONE, 'andersen': ANDERSEN, 'berendsen': BERENDSEN, 'langevin': LANGEVIN}
+
+def make_rng(seed = None):
+  return np.random.Generator(np.random.Philox(seed))
+
+def get_rng_state(rng):
+  """
+    Philox state as a dict of arrays (for np.savez)
+  """
+
+  state = rng.bit_generator.state
+  return {
+    'rng_counter': state['state']['counter'],
+    'rng_key': state['state']['key'],
+    'rng_buffer': state['buffer'],
+    'rng_buffer_pos': state['buffer_pos'],
+    'rng_has_uint32': state['has_uint32'],
+    'rng_uinteger': state['uinteger']
+  }
+
+def set_rng_state(rng, state):
+  rng.bit_generator.state = {
+    'bit_generator': 'Philox',
+    'state': {'counter': np.array(state['rng_counter'], dtype=np.uint64), 'key': np.array(state['rng_key'], dtype=np.uint64)},
+    'buffer': np.array(state['rng_buffer'], dtype=np.uint64),
+    'buffer_pos': int(state['rng_buffer_pos']),
+    'has_uint32': int(state['rng_has_uint32']),
+    'uinteger': int(state['rng_uinteger'])
+  }
+
+# Gaussian velocities with standard deviation sigma for all particles, drawn in one batch
+@nmb.jit(nopython=True, cache=True)
+def draw_velocities(vel, sigma, rng):
+  vel[:, :] = sigma * rng.standard_normal(vel.shape)
+
+# Andersen thermostat: each particle collides with the heat bath with the given probability
+@nmb.jit(nopython=True, cache=True)
+def andersen(vel, sigma, probability, rng):
+  if probability >= 1.0:
+    draw_velocities(vel, sigma, rng)
+    return
+  n, d = vel.shape
+  collide = rng.random(n) < probability
+  xi = rng.standard_normal(vel.shape)
+  for i in range(n):
+    if collide[i]:
+      for k in range(d):
+        vel[i, k] = sigma * xi[i, k]
+
+# Berendsen thermostat: scales velocities so the temperature relaxes to kBT with time constant tau
+# (applied every interval steps, so the relaxation step is interval*dt)
+@nmb.jit(nopython=True, cache=True)
+def berendsen(vel, mass, kBT, dt, tau):
+  n, d = vel.shape
+  Ekin = 0.5 * mass * np.sum(vel * vel)
+  if Ekin == 0.0:
+    return
+  # d degrees of freedom per particle: Ekin = d/2 n kB T
+  scale = np.sqrt(1.0 + dt / tau * (0.5 * d * n * kBT / Ekin - 1.0))
+  vel *= scale
+
+# Applies the thermostat that acts between steps (Andersen, Berendsen) before the propagation of step
+@nmb.jit(nopython=True, cache=True)
+def apply_thermostat(thermostat, interval, param, step, vel, mass, kBT, dt, rng):
+  if interval <= 0 or (step + 1) % interval != 0:
+    return
+  if thermostat == ANDERSEN:
+    andersen(vel, np.sqrt(kBT / mass), param, rng)
+  elif thermostat == BERENDSEN:
+    berendsen(vel, mass, kBT, interval * dt, param)
+
+# Velocity Verlet step as propagate_velocity_verlet, but with the drift split in two halves around
+# an exact Ornstein-Uhlenbeck update of the velocities (BAOAB), which samples the canonical
+# ensemble at kBT for friction gamma. Returns the kinetic energy.
+@nmb.jit(nopython=True, cache=True)
+def propagate_baoab(pos, vel, force, mass, invmass, dt, L, first_step, gamma, kBT, rng):
+  n, d = pos.shape
+  c1 = np.exp(-gamma * dt)
+  c2 = np.sqrt((1.0 - c1 * c1) * kBT / mass)
+  xi = rng.standard_normal(pos.shape)
+  Ekin = 0.0
+  for i in range(n):
+    for k in range(d):
+      if not first_step:
+        vel[i, k] += force[i, k]*invmass*0.5*dt
+      Ekin += 0.5*mass*vel[i, k]*vel[i, k]
+      vel[i, k] += force[i, k]*invmass*0.5*dt
+      pos[i, k] += vel[i, k] * 0.5 * dt
+      vel[i, k] = c1 * vel[i, k] + c2 * xi[i, k]
+      pos[i, k] = (pos[i, k] + vel[i, k] * 0.5 * dt) % L[k]
+  return Ekin
@@ -0,0 +1,142 @@
+# Streaming trajectory output for MDsimulator
+
+import os
+import struct
+import numpy as np
+
+from md_worker import BackgroundWorker
+
+"""
+    A trajectory is a plain .npy file of shape (frames, 2, n, d) holding the positions and
+    velocities of every particle per frame, so it can be opened memory mapped with read_trajectory (or np.load with
+    mmap_mode='r') for random access to any frame without reading the whole file.
+
+    Frames are collected in a buffer of chunk_frames frames. Full buffers are written by a
+    md_worker.BackgroundWorker while the simulation keeps going; two buffers are used in turn,
+    so the simulation only waits if the disk falls more than a whole chunk behind. The .npy header is
+    rewritten after every chunk, so a file is readable while the run is still going
+    (and whatever was written survives a crash).
+
+    The file is only created at the first write. Until then resume can switch the writer to
+    continue the frames already in the file, which is how a run restarted from a checkpoint
+    keeps the trajectory written before it.
+"""
+
+# Header size in bytes, fixed so the frame count can be rewritten in place
+HEADER_SIZE = 128
+
+def npy_header(frames, n, d):
+  header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, 2, %d, %d), }" % (frames, n, d)
+  header = header.ljust(HEADER_SIZE - 10 - 1) + '\n'
+  return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+class TrajectoryWriter:
+  def __init__(self, filename, n, d = 2, chunk_frames = 64, background = True):
+    self.filename = filename
+    self.n = n
+    self.d = d
+    self.frames = 0
+    self.file = None
+
+    self.chunk_frames = chunk_frames
+    self.buffer = np.empty((chunk_frames, 2, n, d))
+    self.count = 0
+
+    self.worker = None
+    if background:
+      self.worker = BackgroundWorker(self.write_chunk, np.empty((chunk_frames, 2, n, d)))
+
+  def append(self, pos, vel):
+    """
+      Copies one frame into the buffer, handing the buffer over for writing when full
+    """
+
+    if self.worker is not None:
+      self.worker.check()
+    frame = self.buffer[self.count]
+    frame[0] = pos
+    frame[1] = vel
+    self.count += 1
+    if self.count == self.chunk_frames:
+      self.flush()
+
+  def resume(self, frames):
+    """
+      Continues the trajectory in the file after its first frames; any frames after those are dropped.
+      Must be called before the first frame is appended.
+    """
+
+    if self.file is not None or self.count > 0:
+      raise ValueError('resume must be called before any frame is appended')
+    size = HEADER_SIZE + frames * self.buffer[0].nbytes
+    if frames > 0 and (not os.path.exists(self.filename) or os.path.getsize(self.filename) < size):
+      raise ValueError(f'{self.filename} holds fewer than {frames} frames')
+    self.frames = frames
+
+  def open(self):
+    """
+      Creates the file, or cuts it back to the frames being continued after resume
+    """
+
+    if self.frames == 0:
+      self.file = open(self.filename, 'wb')
+    else:
+      self.file = open(self.filename, 'r+b')
+      self.file.truncate(HEADER_SIZE + self.frames * self.buffer[0].nbytes)
+    self.file.write(npy_header(self.frames, self.n, self.d))
+    self.file.seek(0, 2)
+
+  def flush(self):
+    if self.count == 0:
+      return
+    if self.worker is not None:
+      self.buffer = self.worker.submit(self.buffer, self.count)
+    else:
+      self.write_chunk(self.buffer, self.count)
+    self.count = 0
+
+  def sync(self):
+    """
+      Writes all frames appended so far, waits until they are on disk and returns their number
+    """
+
+    self.flush()
+    if self.worker is not None:
+      self.worker.join()
+    if self.file is None:
+      self.open()
+    return self.frames
+
+  def write_chunk(self, buffer, count):
+    if self.file is None:
+      self.open()
+    self.file.write(buffer[:count].tobytes())
+    self.frames += count
+    self.file.seek(0)
+    self.file.write(npy_header(self.frames, self.n, self.d))
+    self.file.seek(0, 2)
+    self.file.flush()
+
+  def close(self):
+    """
+      Writes the remaining frames and waits for the writer thread to finish
+    """
+
+    if self.file is not None and self.file.closed:
+      return
+    self.flush()
+    try:
+      if self.worker is not None:
+        self.worker.close()
+      if self.file is None:
+        self.open()
+    finally:
+      if self.file is not None:
+        self.file.close()
+
+def read_trajectory(filename):
+  """
+    Memory maps a trajectory; frame k is traj[k] = [pos, vel]
+  """
+
+  return np.load(filename, mmap_mode = 'r')
@@ -0,0 +1,76 @@
+# Background thread with double buffering, for the trajectory writer and the frame renderer
+
+import queue
+import threading
+
+"""
+    The simulation fills a buffer and hands it over with submit, which returns the other buffer
+    to fill next, while a daemon thread does the work (writing, drawing) on the one handed over.
+    Two buffers are used in turn, so the simulation only waits if the work falls a whole buffer
+    behind.
+
+    An exception in the work is kept and raised in the simulation thread by the next check,
+    join or close; buffers handed over after it are passed back without work.
+"""
+
+class BackgroundWorker:
+  def __init__(self, work, spare):
+    """
+      work(buffer, *args) is called in the thread for every buffer handed over;
+      spare is the second buffer, handed out by the first submit.
+    """
+
+    self.work = work
+    self.error = None
+    self.free = queue.Queue()
+    self.free.put(spare)
+    self.pending = queue.Queue()
+    self.thread = threading.Thread(target = self.loop, daemon = True)
+    self.thread.start()
+
+  def submit(self, buffer, *args):
+    """
+      Hands buffer over for work(buffer, *args) and returns the buffer to fill next
+    """
+
+    self.pending.put((buffer, args))
+    return self.free.get()
+
+  def check(self):
+    if self.error is not None:
+      raise self.error
+
+  def join(self):
+    """
+      Waits until the work on all buffers handed over is done
+    """
+
+    self.pending.join()
+    self.check()
+
+  def close(self):
+    """
+      Finishes the buffers handed over and stops the thread
+    """
+
+    if self.thread.is_alive():
+      self.pending.put(None)
+      self.thread.join()
+    self.check()
+
+  def loop(self):
+    while True:
+      item = self.pending.get()
+      if item is None:
+        self.pending.task_done()
+        return
+      buffer, args = item
+      try:
+        if self.error is None:
+          self.work(buffer, *args)
+      except Exception as e:
+        self.error = e
+      finally:
+        # The buffer has to go back even after an error, or the next submit waits forever
+        self.free.put(buffer)
+        self.pending.task_done()
@@ -1,57 +1,112 @@
+import math
+import numpy as np
 import matplotlib.pyplot as plt
 
+import laplace
+
 
 def print_matrix(matrix):
   print('\n'.join(['\t'.join(['{:.2f}'.format(cell) for cell in row]) for row in matrix]))
 
-def make_2D_array(n):
-  array = []
-  for i in range(n):
-    array.append([])
-    for _ in range(n):
-      array[i].append(0)
-  return array
-
 
 class SquareRegion:
   # Edge values in clockwise order [N E S W]
-  def __init__(self, L = 10, d = 1, edge_values = [10, 10, 10, 10], init_fn = lambda i, j: 10 * 0.9):
+  # omega is the over-relaxation factor of update_sor: None for the optimal value of the
+  # rectangle (Jacobi spectral radius known analytically), 'adaptive' to start from
+  # Gauss-Seidel and raise it from the observed convergence every adapt_interval sweeps,
+  # or a number
+  def __init__(self, L = 10, d = 1, edge_values = [10, 10, 10, 10], init_fn = lambda i, j: 10 * 0.9,
+      omega = None, adapt_interval = 10):
     self.d = d
     self.N = int(L / d) + 1
     self.edge_values = edge_values
-    self.grid = self.init_edges(make_2D_array(self.N), edge_values)
+    self.grid = self.init_edges(np.zeros((self.N, self.N)), edge_values)
     self.init_values(init_fn)
+    self.omega = omega
+    self.adaptive = False
+    self.adapt_interval = adapt_interval
+    self.changes = []
+    self.iterations = 0
 
   @staticmethod
   def init_edges(matrix, values):
     n = len(matrix) - 1
-    for i in range(1, n):
-      matrix[0][i] = values[0]
-      matrix[i][n] = values[1]
-      matrix[n][i] = values[2]
-      matrix[i][0] = values[3]
+    matrix[0, 1:n] = values[0]
+    matrix[1:n, n] = values[1]
+    matrix[n, 1:n] = values[2]
+    matrix[1:n, 0] = values[3]
     return matrix
 
   def average_around(self, i, j):
-    return 0.25 * (self.grid[i + 1][j] + self.grid[i - 1][j] + self.grid[i][j + 1] + self.grid[i][j - 1])
+    return 0.25 * (self.grid[i + 1, j] + self.grid[i - 1, j] + self.grid[i, j + 1] + self.grid[i, j - 1])
 
   def init_values(self, init_fn):
     for i in range(1, self.N - 1):
       for j in range(1, self.N - 1):
-        self.grid[i][j] = init_fn(i, j)
+        self.grid[i, j] = init_fn(i, j)
 
   def update(self):
     for i in range(1, self.N - 1):
       for j in range(1, self.N - 1):
-        self.grid[i][j] = self.average_around(i, j)
+        self.grid[i, j] = self.average_around(i, j)
+    self.iterations += 1
 
   def update_checker(self):
-    for parity in range(2):
-      for i in range(1, self.N - 1):
-        for j in range(1, self.N - 1):
-          if (i + j) % 2 == parity:
-            self.grid[i][j] = self.average_around(i, j)
-    
+    # Red-black Gauss-Seidel, both colors updated as whole arrays (laplace.relax)
+    laplace.relax(self.grid, None, self.d)
+    self.iterations += 1
+
+  def update_sor(self):
+    if self.omega is None:
+      self.omega = self.optimal_omega()
+    elif self.omega == 'adaptive':
+      self.omega = 1.0
+      self.adaptive = True
+    # Adaptive: the changes of the last three sweeps of every adapt_interval are compared
+    phase = self.iterations % self.adapt_interval
+    measure = self.adaptive and phase >= self.adapt_interval - 3
+    if measure:
+      previous = self.grid.copy()
+    laplace.relax(self.grid, None, self.d, self.omega)
+    if measure:
+      self.changes.append(np.linalg.norm(self.grid - previous))
+      if phase == self.adapt_interval - 1:
+        self.adapt_omega(*self.changes)
+        self.changes = []
+    self.iterations += 1
+
+  def optimal_omega(self):
+    # For a rectangle of M x N intervals the Jacobi iteration contracts the slowest mode by
+    # rho = (cos(pi/M) + cos(pi/N))/2, and SOR converges fastest at 2/(1 + sqrt(1 - rho^2))
+    M = N = self.N - 1
+    rho = 0.5 * (math.cos(math.pi / M) + math.cos(math.pi / N))
+    return 2 / (1 + math.sqrt(1 - rho * rho))
+
+  def adapt_omega(self, change0, change1, change2, rtol = 0.1):
+    # Below the optimum, SOR contracts the change per sweep by lambda with
+    # (lambda + omega - 1)^2 = lambda omega^2 rho^2 (Carre), which gives the estimate of the
+    # Jacobi spectral radius rho. omega is only changed once two successive ratios agree (the
+    # slowest mode dominates), and only ever raised. A ratio of omega - 1 or less means the
+    # optimum has been reached (the slowest modes turn complex and all decay by omega - 1)
+    if change0 <= 0 or change1 <= 0:
+      return
+    ratio = change2 / change1
+    if abs(ratio - change1 / change0) > rtol * (1 - ratio) or not self.omega - 1 < ratio < 1:
+      return
+    rho2 = (ratio + self.omega - 1) ** 2 / (ratio * self.omega ** 2)
+    if rho2 < 1:
+      self.omega = max(self.omega, 2 / (1 + math.sqrt(1 - rho2)))
+
+
+# Sweeps region until the largest relative error of the interior against the constant exact
+# potential is below tol; returns the number of sweeps (None if max_iterations is reached)
+def iterations_to_tolerance(region, sweep, exact, tol = 0.01, max_iterations = 10 ** 6):
+  while np.max(np.abs(region.grid[1:-1, 1:-1] - exact)) >= tol * abs(exact):
+    if region.iterations >= max_iterations:
+      return None
+    sweep()
+  return region.iterations
+
 def e_42a():
   N = 50
   Ns = [i for i in range(N + 1)]
@@ -100,7 +155,41 @@ def e_42b():
   plt.savefig('../report/img/4_2b_errorvsn_checker.pdf')
   plt.show()
 
+def e_42c():
+  # Sweeps until every interior point is within 0.1% of the exact V = 10
+  ds = [1, 0.5, 0.2, 0.1, 0.05]
+  methods = {
+    'Jacobi': lambda d: laplace.SquareRegion(d = d),
+    'Gauss-Seidel (red-black)': lambda d: SquareRegion(d = d),
+    'SOR': lambda d: SquareRegion(d = d),
+    'SOR (adaptive omega)': lambda d: SquareRegion(d = d, omega = 'adaptive'),
+  }
+  sweeps = {'Jacobi': 'update', 'Gauss-Seidel (red-black)': 'update_checker', 'SOR': 'update_sor', 'SOR (adaptive omega)': 'update_sor'}
+
+  plt.figure()
+  for name, make in methods.items():
+    counts = []
+    for d in ds:
+      region = make(d)
+      counts.append(iterations_to_tolerance(region, getattr(region, sweeps[name]), 10, tol = 0.001))
+      print(f'{name}, N = {region.N}: {counts[-1]} iterations')
+    plt.plot([int(10 / d) + 1 for d in ds], counts, 'o-', label = name)
+
+  # SOR alone on a 1001 x 1001 grid
+  region = SquareRegion(d = 0.01)
+  print(f'SOR, N = {region.N}: {iterations_to_tolerance(region, region.update_sor, 10, tol = 0.001)} iterations, omega = {region.omega:.4f}')
+
+  plt.xscale('log')
+  plt.yscale('log')
+  plt.xlabel('Grid points per side')
+  plt.ylabel('Iterations')
+  plt.title('Iterations until the relative error is below 0.001')
+  plt.legend()
+  plt.savefig('../report/img/4_2c_iterations.pdf')
+  plt.show()
+
 if __name__ == '__main__':
   pass
   e_42a()
-  e_42b()
\ No newline at end of file
+  e_42b()
+  # e_42c()
\ No newline at end of file
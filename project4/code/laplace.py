@@ -1,54 +1,195 @@
+import math
+import numpy as np
 import matplotlib.pyplot as plt
 
 
 def print_matrix(matrix):
   print('\n'.join(['\t'.join(['{:.2f}'.format(cell) for cell in row]) for row in matrix]))
 
-def make_2D_array(n):
-  array = []
-  for i in range(n):
-    array.append([])
-    for _ in range(n):
-      array[i].append(0)
-  return array
+
+# Multigrid for the 5 point Laplacian with Dirichlet edges (Briggs, Henson and McCormick,
+# A Multigrid Tutorial). A grid of n intervals (n even) has a coarse grid of n/2 intervals
+# with twice the spacing, sharing every other point. u holds the potential including the edges,
+# f the source, A u = (sum of the 4 neighbours - 4 u)/h^2 = f on the interior.
+
+def color_slices(n, parity):
+  # The interior points with (i + j) % 2 == parity of a grid of n intervals, as two strided
+  # blocks (odd and even rows)
+  for i0 in (1, 2):
+    j0 = 1 if (i0 + 1) % 2 == parity else 2
+    yield slice(i0, n, 2), slice(j0, n, 2)
+
+def relax_color(u, f, h, parity, omega = 1.0):
+  # Updates the interior points of one color of A u = f (f = None for the Laplace equation).
+  # They only have neighbours of the other color, so they can all be updated at once. The
+  # neighbours are summed in the order of a point by point sweep (S + N + E + W), and omega = 1
+  # stores the average itself, so Gauss-Seidel gives bitwise the same iterates as that loop
+  n = len(u) - 1
+  for rows, cols in color_slices(n, parity):
+    up, down = slice(rows.start - 1, rows.stop - 1, 2), slice(rows.start + 1, rows.stop + 1, 2)
+    left, right = slice(cols.start - 1, cols.stop - 1, 2), slice(cols.start + 1, cols.stop + 1, 2)
+    total = u[down, cols] + u[up, cols] + u[rows, right] + u[rows, left]
+    if f is not None:
+      total -= h * h * f[rows, cols]
+    average = 0.25 * total
+    if omega == 1.0:
+      u[rows, cols] = average
+    else:
+      u[rows, cols] += omega * (average - u[rows, cols])
+
+def relax(u, f, h, omega = 1.0):
+  # One red-black Gauss-Seidel (over-relaxed with omega) sweep of A u = f
+  for parity in range(2):
+    relax_color(u, f, h, parity, omega)
+
+def residual(u, f, h):
+  # f - A u on the interior, zero on the edges
+  r = np.zeros_like(u)
+  r[1:-1, 1:-1] = f[1:-1, 1:-1] - (u[2:, 1:-1] + u[:-2, 1:-1] + u[1:-1, 2:] + u[1:-1, :-2] - 4 * u[1:-1, 1:-1]) / (h * h)
+  return r
+
+def restrict(r):
+  # Full weighting: every coarse interior point gets the 1/16 (4 centre, 2 sides, 1 corners)
+  # weighted average of the fine points around it; the coarse edges stay zero
+  n = len(r) - 1
+  rc = np.zeros((n // 2 + 1, n // 2 + 1))
+  c, lo, hi = slice(2, n - 1, 2), slice(1, n - 2, 2), slice(3, n, 2)
+  rc[1:-1, 1:-1] = (4 * r[c, c] + 2 * (r[lo, c] + r[hi, c] + r[c, lo] + r[c, hi])
+    + r[lo, lo] + r[lo, hi] + r[hi, lo] + r[hi, hi]) / 16
+  return rc
+
+def prolong(uc):
+  # Bilinear interpolation of a coarse grid onto the fine grid
+  n = 2 * (len(uc) - 1)
+  u = np.empty((n + 1, n + 1))
+  u[::2, ::2] = uc
+  u[1::2, ::2] = 0.5 * (uc[:-1, :] + uc[1:, :])
+  u[::2, 1::2] = 0.5 * (uc[:, :-1] + uc[:, 1:])
+  u[1::2, 1::2] = 0.25 * (uc[:-1, :-1] + uc[:-1, 1:] + uc[1:, :-1] + uc[1:, 1:])
+  return u
+
+def coarse_solve(u, f, h):
+  # Grids that cannot be halved again are solved by SOR at the optimal omega; 2n sweeps
+  # reduce the error by about exp(-4 pi)
+  n = len(u) - 1
+  omega = 2 / (1 + math.sin(math.pi / n)) if n > 1 else 1.0
+  for _ in range(2 * n):
+    relax(u, f, h, omega)
+
+def v_cycle(u, f, h, pre = 2, post = 2):
+  # Smooth, correct the smooth error on the coarse grid (recursively), smooth again
+  n = len(u) - 1
+  if n % 2 == 1 or n <= 2:
+    coarse_solve(u, f, h)
+    return
+  for _ in range(pre):
+    relax(u, f, h)
+  rc = restrict(residual(u, f, h))
+  ec = np.zeros_like(rc)
+  v_cycle(ec, rc, 2 * h, pre, post)
+  u[1:-1, 1:-1] += prolong(ec)[1:-1, 1:-1]
+  for _ in range(post):
+    relax(u, f, h)
+
+def full_multigrid(u, f, h, pre = 2, post = 2):
+  # Solves on the coarse grid first (edges and source taken at the shared points) and starts
+  # the fine V-cycle from its interpolation, which leaves an error of the order of the
+  # discretization error after a single cycle
+  n = len(u) - 1
+  if n % 2 == 1 or n <= 2:
+    coarse_solve(u, f, h)
+    return
+  uc = u[::2, ::2].copy()
+  full_multigrid(uc, f[::2, ::2].copy(), 2 * h, pre, post)
+  u[1:-1, 1:-1] = prolong(uc)[1:-1, 1:-1]
+  v_cycle(u, f, h, pre, post)
 
 
 class SquareRegion:
   # Edge values in clockwise order [N E S W]
+  # The grid is an N x N float array; update writes the next Jacobi iterate into a second
+  # array and swaps the two, so a sweep allocates nothing
   def __init__(self, L = 10, d = 1, edge_values = [10, 10, 10, 10], init_fn = lambda i, j: 10 * 0.9):
     self.d = d
     self.N = int(L / d) + 1
     self.edge_values = edge_values
-    self.grid = self.init_edges(make_2D_array(self.N), edge_values)
+    self.grid = self.init_edges(np.zeros((self.N, self.N)), edge_values)
     self.init_values(init_fn)
+    # The edges never change, so the second buffer keeps them from the start
+    self.grid_new = self.grid.copy()
+    self.iterations = 0
 
   @staticmethod
   def init_edges(matrix, values):
     n = len(matrix) - 1
-    for i in range(1, n):
-      matrix[0][i] = values[0]
-      matrix[i][n] = values[1]
-      matrix[n][i] = values[2]
-      matrix[i][0] = values[3]
+    matrix[0, 1:n] = values[0]
+    matrix[1:n, n] = values[1]
+    matrix[n, 1:n] = values[2]
+    matrix[1:n, 0] = values[3]
     return matrix
 
   @staticmethod
-  def average_around(matrix, i, j):
-    return 0.25 * (matrix[i + 1][j] + matrix[i - 1][j] + matrix[i][j + 1] + matrix[i][j - 1])
+  def average_around(matrix, out):
+    # Interior of out = average of the four neighbours in matrix, summed in the same order
+    # as a cell by cell loop (S + N + E + W), so the iterates are bitwise the same
+    inner = out[1:-1, 1:-1]
+    np.add(matrix[2:, 1:-1], matrix[:-2, 1:-1], out=inner)
+    inner += matrix[1:-1, 2:]
+    inner += matrix[1:-1, :-2]
+    inner *= 0.25
+    return out
 
   def init_values(self, init_fn):
     for i in range(1, self.N - 1):
       for j in range(1, self.N - 1):
-        self.grid[i][j] = init_fn(i, j)
+        self.grid[i, j] = init_fn(i, j)
 
   def update(self):
-    grid_new = self.init_edges(make_2D_array(self.N), self.edge_values)
-
-    for i in range(1, self.N - 1):
-      for j in range(1, self.N - 1):
-        grid_new[i][j] = self.average_around(self.grid, i, j)
-    
-    self.grid = grid_new
+    self.average_around(self.grid, self.grid_new)
+    self.grid, self.grid_new = self.grid_new, self.grid
+    self.iterations += 1
+
+  def solve(self, tol = 0.01, check_every = 10, max_iterations = 10 ** 6):
+    # Jacobi sweeps until the estimated error of every point, relative to its potential, is
+    # below tol; returns the number of sweeps (None if max_iterations is reached).
+    # After a sweep the two buffers hold the last two iterates, so the change is one array
+    # operation, done every check_every sweeps. The change is also a quarter of the residual
+    # (h^2 times) of the previous iterate. The error left is at most rho/(1 - rho) times the
+    # change, with rho = cos(pi/(N - 1)) the contraction of the slowest mode.
+    rho = math.cos(math.pi / (self.N - 1))
+    bound = rho / (1 - rho)
+    start = self.iterations
+    while self.iterations - start < max_iterations:
+      self.update()
+      if (self.iterations - start) % check_every == 0:
+        inner = self.grid[1:-1, 1:-1]
+        change = np.abs(inner - self.grid_new[1:-1, 1:-1])
+        if np.all(bound * change <= tol * np.abs(inner)):
+          return self.iterations - start
+    return None
+
+  def residual_norm(self):
+    # Largest residual of the discrete Laplace equation, as a change of potential
+    # (h^2 times the residual) relative to the largest edge value
+    h = self.d
+    r = residual(self.grid, np.zeros_like(self.grid), h)
+    return h * h * np.max(np.abs(r)) / max(np.max(np.abs(self.edge_values)), 1e-300)
+
+  def solve_multigrid(self, tol = 1e-10, max_cycles = 50, fmg = True):
+    # Solves in place with V-cycles (from init_fn), or full multigrid (fmg, from the edges
+    # alone) followed by V-cycles, until residual_norm is below tol; returns the number of
+    # cycles, an FMG pass counting as one. The work per cycle is O(N^2), a few times that of a
+    # Jacobi sweep, and the number of cycles does not grow with N. N - 1 should have a large
+    # power of 2 as a factor, as the grid is halved only while that is possible.
+    f = np.zeros_like(self.grid)
+    cycles = 0
+    if fmg:
+      full_multigrid(self.grid, f, self.d)
+      cycles += 1
+    while self.residual_norm() >= tol and cycles < max_cycles:
+      v_cycle(self.grid, f, self.d)
+      cycles += 1
+    return cycles
 
 
 def e_41a_1():
@@ -132,23 +273,8 @@ def e_41c_1():
   N = 150
   Ns = [i for i in range(N + 1)]
 
-  reference = SquareRegion(L = L, d = d, edge_values = [10, 5, 10, 5], init_fn = lambda i, j: 7.5)
-  for i in range(1000):
-    reference.update()
-
   region = SquareRegion(L = L, d = d, edge_values = [10, 5, 10, 5], init_fn = lambda i, j: 7.5)
-
-  major_change = True
-  count = 0
-  while major_change:
-    region.update()
-    count += 1
-
-    major_change = False
-    for i in range(1, region.N - 1):
-      for j in range(1, region.N - 1):
-        if abs(region.grid[i][j] - reference.grid[i][j]) / reference.grid[i][j] > 0.01:
-          major_change = True
+  count = region.solve(tol = 0.01)
 
   xs = ys = [i * L / (region.N - 1) for i in range(region.N)]
   prepared = [[cell - 7.5 for cell in row] for row in region.grid]
@@ -169,23 +295,8 @@ def e_41c_2():
   edges = [10, 10, 0, 10]
   Ns = [i for i in range(N + 1)]
 
-  reference = SquareRegion(L = L, d = d, edge_values = edges, init_fn = lambda i, j: 7.5)
-  for i in range(1000):
-    reference.update()
-
   region = SquareRegion(L = L, d = d, edge_values = edges, init_fn = lambda i, j: 7.5)
-
-  major_change = True
-  count = 0
-  while major_change:
-    region.update()
-    count += 1
-
-    major_change = False
-    for i in range(1, region.N - 1):
-      for j in range(1, region.N - 1):
-        if abs(region.grid[i][j] - reference.grid[i][j]) / reference.grid[i][j] > 0.01:
-          major_change = True
+  count = region.solve(tol = 0.01)
 
   # print_matrix(region.grid)
 
@@ -201,10 +312,30 @@ def e_41c_2():
   # plt.savefig('../report/img/4_1c_equipotential_1010010.pdf')
   plt.show()
 
+def e_41d():
+  # Multigrid: the number of cycles stays the same as the grid is refined
+  L = 10
+  Ns = [2 ** k + 1 for k in range(3, 12 + 1)]
+
+  cycles = []
+  for N in Ns:
+    region = SquareRegion(L = L, d = L / (N - 1), edge_values = [10, 5, 10, 5], init_fn = lambda i, j: 7.5)
+    cycles.append(region.solve_multigrid(tol = 1e-8, fmg = False))
+    print(f'N = {N}: {cycles[-1]} V-cycles')
+
+  plt.figure()
+  plt.plot(Ns, cycles, 'o-')
+  plt.xscale('log')
+  plt.xlabel('Grid points per side')
+  plt.ylabel('V-cycles')
+  plt.title('V-cycles until the residual is below 1e-8')
+  plt.show()
+
 if __name__ == '__main__':
   pass
   # e_41a_1()
   # e_41a_2()
   # e_41b()
   # e_41c_1()
-  # e_41c_2()
\ No newline at end of file
+  # e_41c_2()
+  # e_41d()
\ No newline at end of file
@@ -1,4 +1,8 @@
 import random as rng
+import time
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import splu
 import matplotlib.pyplot as plt
 import json
 
@@ -59,6 +63,37 @@ class SquareRegion:
       Vs.append(self.grid[dest_i][dest_j])
     self.grid[i][j] = Vs
 
+# Direct solution of the discrete Laplace equation. The 5 point Laplacian of the interior
+# points only depends on the geometry (the grid size), the edge values only enter the right hand
+# side, so the sparse LU factorization is computed once per grid size and kept in
+# _factorizations; every new set of edge values is then two triangular solves.
+_factorizations = {}
+
+def laplacian_factorization(N):
+  if N not in _factorizations:
+    n = N - 2
+    second_difference = sparse.diags([-1.0, 2.0, -1.0], [-1, 0, 1], shape = (n, n))
+    identity = sparse.identity(n)
+    A = sparse.kron(identity, second_difference) + sparse.kron(second_difference, identity)
+    _factorizations[N] = splu(A.tocsc())
+  return _factorizations[N]
+
+def edge_source(grid):
+  # Right hand side for the interior points: the sum of their neighbours on the edges
+  b = np.zeros((len(grid) - 2, len(grid) - 2))
+  b[0, :] += grid[0, 1:-1]
+  b[-1, :] += grid[-1, 1:-1]
+  b[:, 0] += grid[1:-1, 0]
+  b[:, -1] += grid[1:-1, -1]
+  return b.reshape(-1)
+
+def solve_direct(grid):
+  # The potential for the edge values of grid (an N x N matrix, the interior is ignored)
+  V = np.array(grid, dtype = float)
+  N = len(V)
+  V[1:-1, 1:-1] = laplacian_factorization(N).solve(edge_source(V)).reshape(N - 2, N - 2)
+  return V
+
 def estimate(pos, N, prefix):
   region = SquareRegion()
   region.sample(*pos, N)
@@ -226,6 +261,30 @@ def e_44b_x():
   # plt.savefig('../report/img/4_4b_x_VfromG.pdf')
   plt.show()
 
+def e_44c():
+  # The scenarios of e_44b solved directly, against the Green's function from random walks
+  with open('G.json') as f:
+    G = json.load(f)
+  scenarios = {
+    'no modifications': [],
+    'V = 20 on top': [(0,3), (0,4), (0,5), (0,6), (0,7)],
+    'V = 20 on the left': [(3,0), (4,0), (5,0), (6,0), (7,0)],
+  }
+  for name, positions in scenarios.items():
+    V_walks = np.array(process(set_20(json.loads(json.dumps(G)), *positions)))
+    V_direct = solve_direct(set_20(SquareRegion().grid, *positions))
+    print(f'{name}: largest difference {np.max(np.abs(V_walks - V_direct)[1:-1, 1:-1]):.3f}')
+
+  # Many random edge values on the same geometry reuse one factorization
+  region = SquareRegion()
+  scenarios = 500
+  t_start = time.perf_counter()
+  for _ in range(scenarios):
+    grid = np.array(region.grid, dtype = float)
+    grid[0, 1:-1] = np.random.uniform(0, 20, region.N - 2)
+    solve_direct(grid)
+  print(f'{1e3 * (time.perf_counter() - t_start) / scenarios:.3f} ms per scenario')
+
 def check_G():
   data = []
   with open('G.json') as f:
@@ -242,4 +301,5 @@ if __name__ == '__main__':
   # e_44b_2()
   # e_44b_3()
   # e_44b_x()
+  # e_44c()
   # check_G()
\ No newline at end of file